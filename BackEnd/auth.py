@@ -2,15 +2,15 @@ from datetime import timedelta, datetime
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from database import SessionLocal
 from models import User
-from passlib.context import CryptContext
-from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from jose import jwt, JWTError
+from fastapi.security import OAuth2PasswordRequestForm
 from dotenv import load_dotenv
 from dependencies import get_db, get_current_user_id
+from password_hashing import hash_password, verify_password
+from security import create_access_token, get_current_claims
 import schemas
 import os
 import logging
@@ -24,40 +24,32 @@ router = APIRouter(
     tags=['auth']
 )
 
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("AlGORITHM")
-
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl='auth/token')
-
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
 async def create_user(db: db_dependency, create_user_request: schemas.AuthDetails):
-    existing_user = db.query(User).filter(User.email == create_user_request.email).first()
+    existing_user = (await db.execute(select(User).where(User.email == create_user_request.email))).scalars().first()
     if existing_user is None:
         create_user_model = User(
             email=create_user_request.email,
             age=create_user_request.age,
             gender=create_user_request.gender,
-            hashed_password=bcrypt_context.hash(create_user_request.password),
+            hashed_password=await hash_password(create_user_request.password),
             push_token=None
         )
 
         db.add(create_user_model)
         logger.info("New User Created")
-        db.commit()
-        db.refresh(create_user_model)
-        db.close()
+        await db.commit()
+        await db.refresh(create_user_model)
         return create_user_model
     else:
-        db.close()
         logger.info("Account already exists")
         return {"message": "Account already exists"}
 
 @router.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db:db_dependency):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         logger.error("Could not validate user")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user')
@@ -66,37 +58,25 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
 
     return {'access_token': token, 'token_type': 'bearer'}
 
-def authenticate_user(username: str, password: str, db):
-    user = db.query(User).filter(User.email == username).first()
+async def authenticate_user(username: str, password: str, db: AsyncSession):
+    user = (await db.execute(select(User).where(User.email == username))).scalars().first()
     logger.info("Searching for user in db")
     if not user:
         logger.info("User not ound")
         return False
-    if not bcrypt_context.verify(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
     logger.info("User Found")
     return user
 
-def create_access_token(username: str, user_id: int):
-    encode = {'sub': username, 'id': user_id}
-    return jwt.encode(encode, SECRET_KEY, ALGORITHM)
-
 @router.post("/get_current_user")
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get('sub')
-        user_id: str = payload.get('id')
-        if email is None or user_id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
-        return {'email': email, 'id': user_id}
-    except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
+async def get_current_user(claims: Annotated[dict, Depends(get_current_claims)]):
+    return {'email': claims['sub'], 'id': claims['id']}
 
 @router.post("/update_push_token")
 async def update_push_token(payload: dict, db: db_dependency, user_id: int = Depends(get_current_user_id)):
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if user:
         user.push_token = payload.get("token")
-        db.commit()
+        await db.commit()
     return {"message": "Token updated"}
\ No newline at end of file
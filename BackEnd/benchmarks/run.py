@@ -0,0 +1,238 @@
+"""Benchmark the match path against synthetic trips.
+
+Run from BackEnd/:
+
+    python -m benchmarks.run --sizes 1000 10000 100000
+    python -m benchmarks.run --sizes 1000 --compare benchmarks/results/<baseline>.json
+
+Every run uses a fresh SQLite file, never SQLALCHEMY_DATABASE_URL. The spatial
+index is fakeredis by default, --spatial redis uses a local Redis server
+(its database is flushed) and --spatial memory the in-process index.
+Results go to benchmarks/results/ as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.synthetic import TripGenerator
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+INSERT_CHUNK = 5000
+# A p50 this much slower than the baseline counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="active trips")
+    parser.add_argument("--queries", type=int, default=200, help="trips matched per size")
+    parser.add_argument("--points", type=int, default=50, help="points per route")
+    parser.add_argument("--window-hours", type=float, default=12, help="spread of departure times")
+    parser.add_argument("--spatial", choices=["fakeredis", "redis", "memory"], default="fakeredis")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file, defaults to benchmarks/results/<time>-<commit>.json")
+    parser.add_argument("--compare", help="earlier result file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    return parser.parse_args()
+
+def use_fakeredis():
+    # Has to happen before resources.start() creates the client
+    import fakeredis
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+
+    def async_client(*args, **kwargs):
+        return fakeredis.aioredis.FakeRedis(server=server)
+
+    redis.asyncio.Redis = async_client
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def summarize(samples) -> dict:
+    values = np.array(samples, dtype=float)
+    return {
+        "calls": len(values),
+        "mean_ms": round(float(values.mean()) * 1000, 3),
+        "p50_ms": round(float(np.percentile(values, 50)) * 1000, 3),
+        "p95_ms": round(float(np.percentile(values, 95)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(values, 99)) * 1000, 3),
+        "max_ms": round(float(values.max()) * 1000, 3),
+    }
+
+def load_trips(generated):
+    """Insert the trips through the blocking engine, returns (id, start, end, departure) per trip"""
+    from sqlalchemy import insert, select
+    from database import Base
+    from hausdorff import route_geometry
+    from models import Trip
+    from resources import resources
+
+    engine = resources.engine
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    started = time.perf_counter()
+    rows = [{**trip, **route_geometry(trip["route_coordinates"])} for trip in generated]
+    projection_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        for offset in range(0, len(rows), INSERT_CHUNK):
+            conn.execute(insert(Trip), rows[offset:offset + INSERT_CHUNK])
+        ids = conn.execute(select(Trip.id).order_by(Trip.id)).scalars().all()
+    insert_seconds = time.perf_counter() - started
+
+    indexed = []
+    for trip_id, trip in zip(ids, generated):
+        route = trip["route_coordinates"]
+        indexed.append((
+            trip_id,
+            (route[0]["longitude"], route[0]["latitude"]),
+            (route[-1]["longitude"], route[-1]["latitude"]),
+            trip["time"],
+        ))
+    return indexed, {"projection_s": round(projection_seconds, 3), "insert_s": round(insert_seconds, 3)}
+
+async def measure(index, sample):
+    import hausdorff
+    import trips
+    from models import Trip
+    from resources import resources
+
+    timings = {"geo_lookup": [], "similarity": [], "carpool_match": [], "find_matches_pipeline": []}
+    candidates, matches = [], []
+
+    async with resources.async_session() as db:
+        for trip_id, start, end, departure in sample:
+            trip = await db.get(Trip, trip_id)
+
+            started = time.perf_counter()
+            nearby = await index.match_candidates(trip_id, start, end, departure)
+            timings["geo_lookup"].append(time.perf_counter() - started)
+            candidates.append(len(nearby))
+
+            # Every geo candidate, before the ±30 minute filter of carpool_match.
+            # The first call for a trip builds its KD-trees, the later ones reuse them
+            started = time.perf_counter()
+            await hausdorff.similarity(db, [trip_id, *nearby], {(trip_id, other_id) for other_id in nearby})
+            timings["similarity"].append(time.perf_counter() - started)
+
+            if nearby:
+                started = time.perf_counter()
+                await trips.carpool_match(db=db, trip_id=trip_id, nearby_trips=nearby)
+                timings["carpool_match"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            found = await trips.find_matches_pipeline(db, trip)
+            timings["find_matches_pipeline"].append(time.perf_counter() - started)
+            matches.append(sum(1 for m in found if trip_id in (m["trip1_id"], m["trip2_id"])))
+
+    result = {name: summarize(samples) for name, samples in timings.items() if samples}
+    result["candidates_mean"] = round(float(np.mean(candidates)), 2)
+    result["matches_mean"] = round(float(np.mean(matches)), 2)
+    return result
+
+async def bench_size(size: int, args) -> dict:
+    import hausdorff
+    import spatial_index
+    import trips
+    from resources import resources
+
+    generated = TripGenerator(seed=args.seed, points=args.points, window_hours=args.window_hours).trips(size)
+    await resources.start()
+    try:
+        indexed, load = load_trips(generated)
+
+        # A fresh index per size, shared with the trips router like the real one
+        index = spatial_index.create_spatial_index()
+        if isinstance(index, spatial_index.RedisSpatialIndex):
+            await resources.async_redis.flushdb()
+        trips.spatial_index = index
+        hausdorff._route_trees.clear()
+
+        started = time.perf_counter()
+        await index.add_many(indexed)
+        load["index_s"] = round(time.perf_counter() - started, 3)
+
+        sample = random.Random(args.seed).sample(indexed, min(args.queries, size))
+        result = await measure(index, sample)
+    finally:
+        await resources.close()
+    result["load"] = load
+    return result
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> bool:
+    """Print p50 against the baseline, returns False if any got slower than tolerance allows"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    ok = True
+    for size, stages in results.items():
+        for stage, stats in stages.items():
+            before = baseline.get(size, {}).get(stage)
+            if not isinstance(stats, dict) or "p50_ms" not in stats or not before:
+                continue
+            ratio = stats["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+            regressed = ratio > 1 + tolerance
+            ok = ok and not regressed
+            print(f"{size:>7} {stage:<22} {before['p50_ms']:>9.3f} -> {stats['p50_ms']:>9.3f} ms"
+                  f"  x{ratio:.2f}{'  REGRESSION' if regressed else ''}")
+    return ok
+
+def main():
+    args = parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rideshare-bench-")
+    os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SPATIAL_INDEX_BACKEND"] = "memory" if args.spatial == "memory" else "redis"
+    if args.spatial == "fakeredis":
+        use_fakeredis()
+
+    results = {}
+    for size in args.sizes:
+        print(f"Benchmarking {size} active trips...", file=sys.stderr)
+        results[str(size)] = asyncio.run(bench_size(size, args))
+
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{report['meta']['commit']}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(json.dumps(results, indent=2))
+    print(f"Saved {output}", file=sys.stderr)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import random
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+# (name, longitude, latitude, share of trips). Spans all three UTM zones of
+# hausdorff.get_utm_zone_nigeria: 31N west of 6°E, 32N up to 12°E, 33N east of it
+HOTSPOTS = [
+    ("Lagos", 3.38, 6.52, 0.35),
+    ("Ibadan", 3.90, 7.38, 0.08),
+    ("Benin City", 5.63, 6.34, 0.05),
+    ("Abuja", 7.49, 9.06, 0.17),
+    ("Kano", 8.52, 12.00, 0.10),
+    ("Port Harcourt", 7.01, 4.82, 0.10),
+    ("Enugu", 7.51, 6.45, 0.05),
+    ("Jos", 8.89, 9.90, 0.02),
+    ("Maiduguri", 13.16, 11.85, 0.05),
+    ("Yola", 12.50, 9.21, 0.03),
+]
+
+# Most trips follow one of a city's popular corridors (home to market, campus,
+# airport...), the rest go anywhere in the city
+CORRIDORS_PER_HOTSPOT = 20
+CORRIDOR_SHARE = 0.8
+
+# Spreads in degrees, 0.001° is about 110 m
+ORIGIN_SPREAD = 0.04
+DESTINATION_SPREAD = 0.08
+ENDPOINT_JITTER = 0.003
+POINT_NOISE = 0.0003
+
+def bend_point(origin, destination, rng: random.Random):
+    """A via point off the straight line, so routes curve like roads do"""
+    mid_lon = (origin[0] + destination[0]) / 2
+    mid_lat = (origin[1] + destination[1]) / 2
+    # Perpendicular offset of up to a fifth of the trip length
+    d_lon, d_lat = destination[0] - origin[0], destination[1] - origin[1]
+    offset = rng.uniform(-0.2, 0.2)
+    return (mid_lon - d_lat * offset, mid_lat + d_lon * offset)
+
+def route_points(origin, via, destination, points: int, rng: random.Random) -> List[dict]:
+    # Quadratic Bezier through the via point, with a little GPS-like noise
+    route = []
+    for k in range(points):
+        t = k / (points - 1)
+        lon = (1 - t) ** 2 * origin[0] + 2 * (1 - t) * t * via[0] + t ** 2 * destination[0]
+        lat = (1 - t) ** 2 * origin[1] + 2 * (1 - t) * t * via[1] + t ** 2 * destination[1]
+        route.append({
+            "latitude": round(lat + rng.gauss(0, POINT_NOISE), 6),
+            "longitude": round(lon + rng.gauss(0, POINT_NOISE), 6),
+        })
+    return route
+
+class TripGenerator:
+    """Reproducible trips clustered around Nigerian hotspots"""
+
+    def __init__(self, seed: int = 0, points: int = 50, window_hours: float = 12,
+                 start: Optional[datetime] = None):
+        self.rng = random.Random(seed)
+        self.points = points
+        self.window = timedelta(hours=window_hours)
+        # Departures start an hour out, so nothing expires while a benchmark runs
+        self.start = start or datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=1)
+        self.weights = [share for *_, share in HOTSPOTS]
+        self.corridors = {name: [self.corridor(lon, lat) for _ in range(CORRIDORS_PER_HOTSPOT)]
+                          for name, lon, lat, _ in HOTSPOTS}
+
+    def corridor(self, lon: float, lat: float):
+        origin = (lon + self.rng.gauss(0, ORIGIN_SPREAD), lat + self.rng.gauss(0, ORIGIN_SPREAD))
+        destination = (lon + self.rng.gauss(0, DESTINATION_SPREAD), lat + self.rng.gauss(0, DESTINATION_SPREAD))
+        return origin, bend_point(origin, destination, self.rng), destination
+
+    def trip(self) -> dict:
+        rng = self.rng
+        name, lon, lat, _ = rng.choices(HOTSPOTS, weights=self.weights)[0]
+        if rng.random() < CORRIDOR_SHARE:
+            origin, via, destination = rng.choice(self.corridors[name])
+            origin = (origin[0] + rng.gauss(0, ENDPOINT_JITTER), origin[1] + rng.gauss(0, ENDPOINT_JITTER))
+            destination = (destination[0] + rng.gauss(0, ENDPOINT_JITTER), destination[1] + rng.gauss(0, ENDPOINT_JITTER))
+        else:
+            origin, via, destination = self.corridor(lon, lat)
+
+        return {
+            "origin_name": f"{name} origin",
+            "target_name": f"{name} destination",
+            "time": self.start + self.window * rng.random(),
+            "gender": rng.choice(("male", "female")),
+            "route_coordinates": route_points(origin, via, destination, self.points, rng),
+        }
+
+    def trips(self, count: int) -> List[dict]:
+        return [self.trip() for _ in range(count)]
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire ttl seconds after they are set"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires_at, value), least recently used first
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self.data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return default
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
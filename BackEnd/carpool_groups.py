@@ -0,0 +1,143 @@
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Trip, TripMatch, CarpoolGroup, User
+
+# Trips sharing one car, the driver's included
+CAR_CAPACITY = int(os.getenv("CAR_CAPACITY", "4"))
+
+# Groups are cliques of trip_matches: every member matched every other one, so
+# one car works for all of them. A trip is placed once, when its edges are
+# written, and its group is then read by every member instead of recomputed.
+
+async def neighbours(db: AsyncSession, trip_id: int) -> Dict[int, float]:
+    """Matched trip ids of trip_id with their Hausdorff distance"""
+    result = await db.execute(
+        select(TripMatch.matched_trip_id, TripMatch.hausdorff_distance_km).where(TripMatch.trip_id == trip_id)
+    )
+    return dict(result.all())
+
+async def edges_among(db: AsyncSession, trip_ids: List[int]) -> Set[Tuple[int, int]]:
+    result = await db.execute(
+        select(TripMatch.trip_id, TripMatch.matched_trip_id)
+        .where(TripMatch.trip_id.in_(trip_ids), TripMatch.matched_trip_id.in_(trip_ids))
+    )
+    return set(result.all())
+
+async def join_group(db: AsyncSession, trip: Trip, near: Dict[int, float], group_ids: Set[int]) -> Optional[int]:
+    """The fullest group with room whose members all matched trip, closest first on ties"""
+    if not group_ids:
+        return None
+    # Locked, so two trips arriving together cannot both take the last seat
+    capacity = dict((await db.execute(
+        select(CarpoolGroup.id, CarpoolGroup.capacity).where(CarpoolGroup.id.in_(group_ids)).with_for_update()
+    )).all())
+    members = defaultdict(list)
+    for member_id, group_id in (await db.execute(
+        select(Trip.id, Trip.group_id).where(Trip.group_id.in_(group_ids))
+    )).all():
+        members[group_id].append(member_id)
+
+    best = None
+    for group_id, ids in members.items():
+        if len(ids) < capacity.get(group_id, 0) and all(member_id in near for member_id in ids):
+            score = (len(ids), -sum(near[member_id] for member_id in ids))
+            if best is None or score > best[0]:
+                best = (score, group_id)
+    if best is None:
+        return None
+
+    await db.execute(update(Trip).where(Trip.id == trip.id).values(group_id=best[1]))
+    return best[1]
+
+async def found_group(db: AsyncSession, trip: Trip, near: Dict[int, float], ungrouped: List[int]) -> Optional[int]:
+    """A new group of trip and its closest ungrouped matches that all matched each other"""
+    if not ungrouped:
+        return None
+    ungrouped.sort(key=near.get)
+    edges = await edges_among(db, ungrouped)
+
+    # Greedy clique: take the closest matches first, keep those compatible with everyone taken
+    members = []
+    for candidate in ungrouped:
+        if all((candidate, member_id) in edges for member_id in members):
+            members.append(candidate)
+            if len(members) + 1 == CAR_CAPACITY:
+                break
+
+    group = CarpoolGroup(capacity=CAR_CAPACITY, created_at=datetime.now(timezone.utc))
+    db.add(group)
+    await db.flush()
+    # Only trips still free, another request may have grouped some in the meantime
+    joined = await db.execute(
+        update(Trip).where(Trip.id.in_(members), Trip.group_id.is_(None)).values(group_id=group.id)
+    )
+    if not joined.rowcount:
+        await db.delete(group)
+        return None
+    await db.execute(update(Trip).where(Trip.id == trip.id).values(group_id=group.id))
+    return group.id
+
+async def assign_group(db: AsyncSession, trip: Trip) -> Optional[int]:
+    """Put trip in a car: join an existing group if it fits, otherwise start one.
+    Returns the group id, None if there is nobody to share with. The caller commits."""
+    # Bulk ingestion places several new trips in a row, an earlier one may have taken this one along
+    current = await db.scalar(select(Trip.group_id).where(Trip.id == trip.id))
+    if current is not None:
+        return current
+
+    near = await neighbours(db, trip.id)
+    if not near:
+        return None
+
+    groups = dict((await db.execute(select(Trip.id, Trip.group_id).where(Trip.id.in_(near)))).all())
+    group_id = await join_group(db, trip, near, {g for g in groups.values() if g is not None})
+    if group_id is None:
+        group_id = await found_group(db, trip, near, [t for t, g in groups.items() if g is None])
+    return group_id
+
+def groups_of(trip_ids: List[int]):
+    """Groups the given trips belong to, read before the trips are deleted"""
+    return select(Trip.group_id).where(Trip.id.in_(trip_ids), Trip.group_id.is_not(None)).distinct()
+
+async def settle_groups(db: AsyncSession, group_ids: Iterable[int]) -> List[int]:
+    """Tidy groups that lost members: empty ones go, a lone member is placed again.
+    Returns the ids of the trips whose group changed. The caller commits."""
+    group_ids = list(group_ids)
+    if not group_ids:
+        return []
+
+    remaining = defaultdict(list)
+    for trip_id, group_id in (await db.execute(
+        select(Trip.id, Trip.group_id).where(Trip.group_id.in_(group_ids))
+    )).all():
+        remaining[group_id].append(trip_id)
+
+    changed = [trip_id for ids in remaining.values() for trip_id in ids]
+    lone = [ids[0] for ids in remaining.values() if len(ids) == 1]
+    dissolved = [group_id for group_id in group_ids if len(remaining.get(group_id, ())) <= 1]
+    if lone:
+        await db.execute(update(Trip).where(Trip.id.in_(lone)).values(group_id=None))
+    if dissolved:
+        await db.execute(delete(CarpoolGroup).where(CarpoolGroup.id.in_(dissolved)))
+
+    for trip in (await db.execute(select(Trip).where(Trip.id.in_(lone)))).scalars():
+        await assign_group(db, trip)
+    return changed
+
+async def load_group(db: AsyncSession, group_id: int) -> List[Tuple[Trip, User]]:
+    result = await db.execute(
+        select(Trip, User).join(User, User.id == Trip.user_id).where(Trip.group_id == group_id).order_by(Trip.time)
+    )
+    return result.all()
+
+def group_members(group_ids: List[int]):
+    """(user_id, trip_id, group_id) of everyone in the groups"""
+    return select(Trip.user_id, Trip.id, Trip.group_id).where(Trip.group_id.in_(group_ids))
+
+def trip_groups(trip_ids: List[int]):
+    """(user_id, trip_id, group_id) of the given trips"""
+    return select(Trip.user_id, Trip.id, Trip.group_id).where(Trip.id.in_(trip_ids))
@@ -1,5 +1,7 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import declarative_base
 from dotenv import load_dotenv
 import os
 
@@ -7,8 +9,80 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Pool per worker process: requests are served from pool_size connections and may
+# burst to pool_size + max_overflow, pre-ping drops connections Postgres closed
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def async_database_url(url: str) -> str:
+    """The same database, through an asyncio driver"""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
 
-Base = declarative_base()
\ No newline at end of file
+def pool_options(url: str) -> dict:
+    # SQLite uses its own pool classes which take none of these
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+def create_engines(url: str = None):
+    """The blocking engine, only for creating tables and maintenance jobs, and the one
+    used by the request handlers. Built by resources.start(), not at import."""
+    url = url or SQLALCHEMY_DATABASE_URL
+    engine = create_engine(url, pool_pre_ping=True)
+    async_engine = create_async_engine(async_database_url(url), **pool_options(url))
+    return engine, async_engine
+
+Base = declarative_base()
+
+# Every worker runs create_tables at startup. On Postgres they take turns under this
+# advisory lock, so a worker only inspects the schema once the previous one committed
+# its changes, instead of all of them adding the same column and all but one failing.
+SCHEMA_LOCK_KEY = 7243100
+
+def add_missing_columns(conn) -> None:
+    """Add the model columns that tables created by an older version lack.
+    create_all only creates whole tables, it never alters one that exists."""
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                definition = str(CreateColumn(column).compile(dialect=conn.dialect))
+                # CreateColumn leaves foreign keys to the table definition, e.g. trips.group_id
+                for foreign_key in column.foreign_keys:
+                    definition += (f" REFERENCES {preparer.format_table(foreign_key.column.table)}"
+                                   f" ({preparer.quote(foreign_key.column.name)})")
+                    if foreign_key.ondelete:
+                        definition += f" ON DELETE {foreign_key.ondelete}"
+                conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition}"))
+
+def create_tables(engine) -> None:
+    """Create missing tables, columns and indexes, run once per worker at startup"""
+    import models
+
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Released when the transaction ends
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        Base.metadata.create_all(bind=conn)
+        # Before the indexes, some of them are on the added columns
+        add_missing_columns(conn)
+        # create_all skips indexes of tables that already exist
+        for index in models.Trip.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
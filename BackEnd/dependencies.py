@@ -1,32 +1,8 @@
-from database import SessionLocal
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError
-import jwt
-import os
+from resources import resources
+from sqlalchemy.ext.asyncio import AsyncSession
+# Token verification lives in security, re-exported for existing imports
+from security import get_current_user_id
 
-def get_db() -> Session:
-    db = SessionLocal()
-    try:
+async def get_db() -> AsyncSession:
+    async with resources.async_session() as db:
         yield db
-    finally:
-        db.close()
-
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-
-def get_current_user_id(token: str = Depends(oauth2_scheme)) -> int:
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return user_id
-    except JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-        )
\ No newline at end of file
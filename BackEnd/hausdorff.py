@@ -1,11 +1,38 @@
 import numpy as np
+import hashlib
 import json
-import pyproj
-import math
-from sqlalchemy.orm import Session
-from typing import List
-from scipy.spatial.distance import directed_hausdorff
+import os
+from collections import OrderedDict
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import TYPE_CHECKING, Iterable, List, Sequence, Tuple
 from models import Trip
+from metrics import stage_seconds
+import parallel_match
+from resources import resources
+
+# pyproj and scipy take a while to import, they load on first use or in warm_up
+if TYPE_CHECKING:
+    import pyproj
+    from scipy.spatial import cKDTree
+
+CARPOOL_THRESHOLD_M = 1000
+
+# Layout of Trip.route_xy: interleaved little-endian float64 x, y pairs in metres
+ROUTE_DTYPE = np.dtype('<f8')
+
+# Largest change simplification may cause in a pair's Hausdorff distance (metres).
+# Each route is simplified with half of it, so two simplified routes stay within it.
+ROUTE_SIMPLIFY_TOLERANCE_M = float(os.getenv("ROUTE_SIMPLIFY_TOLERANCE_M", "50"))
+
+# KD-trees of active trips' routes, least recently used first. Keyed by (trip_id, utm_crs,
+# digest of the points): ids are reused once a trip is gone, and pool processes and
+# other workers never hear of cancellations, so a stale tree must never match by id alone.
+ROUTE_TREE_CACHE_SIZE = int(os.getenv("ROUTE_TREE_CACHE_SIZE", "4096"))
+_route_trees: "OrderedDict[tuple, cKDTree]" = OrderedDict()
+
+# Points per KD-tree query in the threshold decision, so a failing pair stops early
+DECISION_CHUNK_SIZE = 256
 
 def get_utm_zone_nigeria(lon: float) -> str:
     lon = float(lon)
@@ -18,48 +45,284 @@ def get_utm_zone_nigeria(lon: float) -> str:
     else:
         return "EPSG:32633"  # East
 
-def similarity(db: Session, matches: List[int]):
-    results = []
-    num_matches = len(matches)
+def get_transformer(utm_crs: str) -> "pyproj.Transformer":
+    return resources.transformer(utm_crs)
+
+def warm_up() -> None:
+    """Import scipy and build the transformer of every Nigerian zone ahead of the first request"""
+    import scipy.spatial
+    for lon in (3, 9, 13):
+        get_transformer(get_utm_zone_nigeria(lon))
+
+def load_route(route_coordinates) -> list:
+    # Routes are stored as a JSON string inside the JSON column
+    if isinstance(route_coordinates, str):
+        return json.loads(route_coordinates)
+    return route_coordinates
+
+def project_route(coords: list, utm_crs: str) -> np.ndarray:
+    """Project a list of {latitude, longitude} dicts to an (n, 2) array of metres"""
+    lons = np.fromiter((p['longitude'] for p in coords), dtype=np.float64, count=len(coords))
+    lats = np.fromiter((p['latitude'] for p in coords), dtype=np.float64, count=len(coords))
+    x, y = get_transformer(utm_crs).transform(lons, lats)
+    return np.column_stack((x, y))
+
+def pack_route(xy: np.ndarray) -> bytes:
+    return np.ascontiguousarray(xy, dtype=ROUTE_DTYPE).tobytes()
+
+def unpack_route(blob: bytes) -> np.ndarray:
+    # Zero-copy, read-only view over the stored bytes
+    return np.frombuffer(blob, dtype=ROUTE_DTYPE).reshape(-1, 2)
+
+def simplify_route(xy: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker simplification that also keeps every dropped point within
+    tolerance of a kept point, so the Hausdorff distance between the point sets
+    of the full and the simplified route is at most tolerance"""
+    num_points = len(xy)
+    if num_points < 3 or tolerance <= 0:
+        return xy
+
+    keep = np.zeros(num_points, dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, num_points - 1)]
+
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+
+        inner = xy[first + 1:last]
+        start, end = xy[first], xy[last]
+
+        # Distance of each inner point to the chord and to the nearer chord end
+        from_start = np.hypot(*(inner - start).T)
+        from_end = np.hypot(*(inner - end).T)
+        vertex_error = np.minimum(from_start, from_end)
+        if vertex_error.max() <= tolerance:
+            continue
+
+        chord = end - start
+        chord_sq = chord @ chord
+        if chord_sq > 0:
+            t = np.clip((inner - start) @ chord / chord_sq, 0, 1)
+            chord_error = np.hypot(*(inner - (start + t[:, None] * chord)).T)
+        else:
+            chord_error = from_start
+
+        # Classic Douglas-Peucker split while the shape is off, otherwise split
+        # where a point would end up furthest from any kept point
+        if chord_error.max() > tolerance:
+            split = first + 1 + int(np.argmax(chord_error))
+        else:
+            split = first + 1 + int(np.argmax(vertex_error))
+
+        keep[split] = True
+        spans.append((first, split))
+        spans.append((split, last))
+
+    return xy[keep]
+
+def route_geometry(coords: list) -> dict:
+    """Trip column values for a route, computed once when the trip is written"""
+    if not coords:
+        return {}
 
-    trips_cache = {t.id: t for t in db.query(Trip).filter(Trip.id.in_(matches)).all()}
+    utm_crs = get_utm_zone_nigeria(coords[0]['longitude'])
+    xy = project_route(coords, utm_crs)
+    min_x, min_y = xy.min(axis=0).tolist()
+    max_x, max_y = xy.max(axis=0).tolist()
+    return {
+        "route_utm_crs": utm_crs,
+        "route_xy": pack_route(xy),
+        "route_xy_simplified": pack_route(simplify_route(xy, ROUTE_SIMPLIFY_TOLERANCE_M / 2)),
+        "bbox_min_x": min_x,
+        "bbox_min_y": min_y,
+        "bbox_max_x": max_x,
+        "bbox_max_y": max_y,
+    }
 
-    for i in range(num_matches):
-        # modulo to wrap the last trip back to the first trip
-        id1 = matches[i]
-        id2 = matches[(i + 1) % num_matches]
+def trip_route_xy(trip: Trip, utm_crs: str, simplified: bool = True) -> np.ndarray:
+    # Use the stored projection when it is in the zone we are matching in,
+    # otherwise (other zone, or rows written before route_xy existed) project now
+    if trip.route_utm_crs == utm_crs:
+        if simplified and trip.route_xy_simplified is not None:
+            return unpack_route(trip.route_xy_simplified)
+        if trip.route_xy is not None:
+            return unpack_route(trip.route_xy)
+    route = load_route(trip.route_coordinates)
+    if not route:
+        return np.empty((0, 2))
+    return project_route(route, utm_crs)
 
-        trip1 = trips_cache.get(id1)
-        trip2 = trips_cache.get(id2)
+def trip_utm_crs(trip: Trip):
+    if trip.route_utm_crs is not None:
+        return trip.route_utm_crs
+    route = load_route(trip.route_coordinates)
+    if not route:
+        return None
+    return get_utm_zone_nigeria(route[0]['longitude'])
 
-        if trip1 and trip2:
-            coords_list_1 = json.loads(trip1.route_coordinates)
-            coords_list_2 = json.loads(trip1.route_coordinates)
-            first_point = coords_list_1[0]
-            start_lon = first_point['longitude']
-            utm_crs = get_utm_zone_nigeria(start_lon)
+def trip_bbox(trip: Trip, utm_crs: str, xy: np.ndarray) -> tuple:
+    # The stored box is of the full route, so it stays a valid bound for simplified xy
+    if trip.route_utm_crs == utm_crs and trip.bbox_min_x is not None:
+        return (trip.bbox_min_x, trip.bbox_min_y, trip.bbox_max_x, trip.bbox_max_y)
+    return (*xy.min(axis=0).tolist(), *xy.max(axis=0).tolist())
 
-            # Project coordinates (Degrees -> Meters)
-            transformer = pyproj.Transformer.from_crs("EPSG:4326", utm_crs, always_xy=True)
-            point_1 = [(p['longitude'], p['latitude']) for p in coords_list_1]
-            point_2 = [(p['longitude'], p['latitude']) for p in coords_list_2]
+def bbox_lower_bounds(bboxes: np.ndarray) -> np.ndarray:
+    """Lower bound on the Hausdorff distance of every pair from (min_x, min_y, max_x, max_y) boxes.
+
+    The point of route A on its min_x edge is at least |A.min_x - B.min_x| from
+    every point of B when B lies to its right (and likewise for the other edges),
+    so the largest edge offset never exceeds the true distance."""
+    return np.abs(bboxes[:, None, :] - bboxes[None, :, :]).max(axis=2)
+
+def route_tree(trip_id: int, utm_crs: str, xy: np.ndarray) -> "cKDTree":
+    from scipy.spatial import cKDTree
+
+    key = (trip_id, utm_crs, hashlib.blake2b(xy.tobytes(), digest_size=8).digest())
+    tree = _route_trees.get(key)
+    if tree is None:
+        tree = cKDTree(xy)
+        _route_trees[key] = tree
+        if len(_route_trees) > ROUTE_TREE_CACHE_SIZE:
+            _route_trees.popitem(last=False)
+    else:
+        _route_trees.move_to_end(key)
+    return tree
+
+def forget_trips(trip_ids) -> None:
+    """Drop cached KD-trees once trips are cancelled or expire"""
+    trip_ids = set(trip_ids)
+    for key in [key for key in _route_trees if key[0] in trip_ids]:
+        del _route_trees[key]
+
+def directed_within(points: np.ndarray, tree: "cKDTree", threshold: float) -> float:
+    """Directed Hausdorff distance from points to the route in tree if it is
+    below threshold, otherwise inf as soon as one point is found too far away"""
+    # An evenly spread sample first: diverging routes usually fail on it
+    stride = max(1, len(points) // 16)
+    chunks = [points[::stride]]
+    chunks += [points[i:i + DECISION_CHUNK_SIZE] for i in range(0, len(points), DECISION_CHUNK_SIZE)]
+
+    worst = 0.0
+    for chunk in chunks:
+        nearest, _ = tree.query(chunk, distance_upper_bound=threshold)
+        chunk_worst = nearest.max()
+        if chunk_worst >= threshold:
+            return np.inf
+        worst = max(worst, chunk_worst)
+    return float(worst)
+
+def pair_distances(routes, trees, pairs: np.ndarray, threshold: float) -> np.ndarray:
+    """Hausdorff distance of each (i, j) in pairs if below threshold, otherwise inf"""
+    distances = np.full(len(pairs), np.inf)
+    for k, (i, j) in enumerate(pairs.tolist()):
+        forward = directed_within(routes[i], trees[j], threshold)
+        if forward < threshold:
+            distances[k] = max(forward, directed_within(routes[j], trees[i], threshold))
+    return distances
+
+def hausdorff_matrix(routes: Sequence[np.ndarray], candidates: np.ndarray = None,
+                     threshold: float = None, trees: Sequence["cKDTree"] = None) -> np.ndarray:
+    """Symmetric Hausdorff distance matrix (metres) between projected routes.
+
+    Pairs left out of the (symmetric) candidates mask are reported as inf. With a
+    threshold only pairs below it get their exact distance, the rest are inf."""
+    from scipy.spatial import cKDTree
+
+    num_routes = len(routes)
+    if candidates is None:
+        candidates = np.ones((num_routes, num_routes), dtype=bool)
+
+    # directed[i, j] = directed Hausdorff distance from route i to route j
+    directed = np.full((num_routes, num_routes), np.inf)
+    np.fill_diagonal(directed, 0)
+
+    if threshold is not None:
+        if trees is None:
+            trees = [cKDTree(route) for route in routes]
+        pairs = np.argwhere(np.triu(candidates, k=1))
+        distances = np.full((num_routes, num_routes), np.inf)
+        np.fill_diagonal(distances, 0)
+        distances[pairs[:, 0], pairs[:, 1]] = pair_distances(routes, trees, pairs, threshold)
+        return np.minimum(distances, distances.T)
+
+    for j, route in enumerate(routes):
+        rows = np.flatnonzero(candidates[:, j])
+        rows = rows[rows != j]
+        if not len(rows):
+            continue
+
+        # Every candidate's points in one query, offsets mark where each route starts
+        points = np.concatenate([routes[i] for i in rows])
+        offsets = np.cumsum([0] + [len(routes[i]) for i in rows[:-1]])
+        nearest, _ = cKDTree(route).query(points)
+        directed[rows, j] = np.maximum.reduceat(nearest, offsets)
+
+    return np.maximum(directed, directed.T)
+
+def prepare_match(trips: List[Trip], allowed: Iterable[Tuple[int, int]] = None):
+    """(utm_crs, [(trip, xy)], candidate mask) for the routes worth comparing, None if fewer than two.
+    allowed, if given, limits the comparisons to those pairs of trip ids."""
+    utm_crs = next((crs for crs in map(trip_utm_crs, trips) if crs is not None), None)
+    if utm_crs is None:
+        return None
+
+    # Every route in the zone of the first (requesting) trip
+    routes = []
+    bboxes = []
+    for trip in trips:
+        xy = trip_route_xy(trip, utm_crs)
+        if len(xy):
+            routes.append((trip, xy))
+            bboxes.append(trip_bbox(trip, utm_crs, xy))
+
+    if len(routes) < 2:
+        return None
+
+    # Pairs whose boxes are already a kilometre apart never reach the KD-trees
+    candidates = bbox_lower_bounds(np.array(bboxes)) < CARPOOL_THRESHOLD_M
+    if allowed is not None:
+        position = {trip.id: i for i, (trip, _) in enumerate(routes)}
+        mask = np.zeros_like(candidates)
+        for a, b in allowed:
+            if a in position and b in position:
+                mask[position[a], position[b]] = mask[position[b], position[a]] = True
+        candidates &= mask
+    return utm_crs, routes, candidates
+
+def match_results(utm_crs: str, routes, distances: np.ndarray) -> List[dict]:
+    results = []
+    rows, cols = np.nonzero(np.triu(distances < CARPOOL_THRESHOLD_M, k=1))
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        results.append({
+            "trip1_id": routes[i][0].id,
+            "trip2_id": routes[j][0].id,
+            "hausdorff_distance_km": round(float(distances[i, j]) / 1000, 3),
+            "is_carpoolable": True,
+            "used_utm_zone": utm_crs
+        })
 
-            trip1_projected = np.array(list(transformer.itransform(point_1)))
-            trip2_projected = np.array(list(transformer.itransform(point_2)))
+    return results
 
-            # The [0] index gets the actual distance from the scipy result
-            d_1_to_2 = directed_hausdorff(trip1_projected, trip2_projected)[0]
-            d_2_to_1 = directed_hausdorff(trip2_projected, trip1_projected)[0]
+def match_trips(trips: List[Trip]):
+    prepared = prepare_match(trips)
+    if prepared is None:
+        return []
+    utm_crs, routes, candidates = prepared
+    trees = [route_tree(trip.id, utm_crs, xy) for trip, xy in routes]
+    distances = hausdorff_matrix([xy for _, xy in routes], candidates, CARPOOL_THRESHOLD_M, trees)
+    return match_results(utm_crs, routes, distances)
 
-            hausdorff_meters = max(d_1_to_2, d_2_to_1)
+async def similarity(db: AsyncSession, matches: List[int], allowed: Iterable[Tuple[int, int]] = None):
+    """Matches among the trips in matches, only between the pairs in allowed if given"""
+    with stage_seconds.time("route_fetch"):
+        result = await db.execute(select(Trip).where(Trip.id.in_(matches)))
+        trips_cache = {t.id: t for t in result.scalars()}
 
-            if hausdorff_meters < 1000:
-                results.append({
-                    "trip1_id": id1,
-                    "trip2_id": id2,
-                    "hausdorff_distance_km": round(hausdorff_meters / 1000, 3),
-                    "is_carpoolable": True,
-                    "used_utm_zone": utm_crs
-                })
+    # Keep the order of matches (the requesting trip comes first) and drop duplicates
+    trips = [trips_cache[tid] for tid in dict.fromkeys(matches) if tid in trips_cache]
 
-    return results
\ No newline at end of file
+    with stage_seconds.time("hausdorff"):
+        # Large candidate sets are spread over the process pool, the rest run here
+        return await parallel_match.match_trips(trips, allowed)
@@ -0,0 +1,78 @@
+import asyncio
+import random
+import uuid
+from typing import List
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Place names the autocomplete mock answers with, whatever was typed
+PLACES = [
+    "Lekki Phase 1", "Victoria Island", "Ikeja City Mall", "Yaba Tech", "Ajah Market",
+    "Surulere", "Maryland Mall", "Oshodi Interchange", "Murtala Muhammed Airport", "Festac Town",
+]
+
+class Latency:
+    """Simulated upstream latency, mean plus or minus jitter, in milliseconds"""
+
+    def __init__(self, mean_ms: float, jitter_ms: float = 0.0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+
+    async def wait(self) -> None:
+        delay = max(0.0, self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms))
+        if delay:
+            await asyncio.sleep(delay / 1000)
+
+def interpolate(coordinates: List[List[float]], points: int) -> List[List[float]]:
+    """A road-like polyline through the requested [lon, lat] waypoints"""
+    route = []
+    legs = len(coordinates) - 1
+    per_leg = max(2, points // max(legs, 1))
+    for (lon1, lat1), (lon2, lat2) in zip(coordinates, coordinates[1:]):
+        for k in range(per_leg):
+            t = k / per_leg
+            route.append([lon1 + (lon2 - lon1) * t, lat1 + (lat2 - lat1) * t])
+    route.append(list(coordinates[-1]))
+    return route
+
+def mock_app(ors_latency: Latency, expo_latency: Latency, points: int = 50) -> FastAPI:
+    """OpenRouteService and Expo on one server, their paths do not overlap"""
+    app = FastAPI()
+    calls = {"autocomplete": 0, "directions": 0, "push_requests": 0, "push_messages": 0, "push_rejected": 0}
+
+    @app.get("/geocode/autocomplete")
+    async def autocomplete(text: str, size: int = 3):
+        calls["autocomplete"] += 1
+        await ors_latency.wait()
+        names = [name for name in PLACES if name.lower().startswith(text.lower())] or PLACES
+        return {"features": [
+            {"properties": {"name": name, "label": f"{name}, Lagos, Nigeria", "id": str(i), "country": "Nigeria"}}
+            for i, name in enumerate(names[:size])
+        ]}
+
+    @app.post("/v2/directions/driving-car/geojson")
+    async def directions(body: dict):
+        calls["directions"] += 1
+        await ors_latency.wait()
+        return {"features": [{
+            "geometry": {"type": "LineString", "coordinates": interpolate(body["coordinates"], points)},
+            "properties": {"summary": {"duration": 900.0, "distance": 10000.0}},
+        }]}
+
+    @app.post("/--/api/v2/push/send")
+    async def push(request: Request):
+        # Expo only takes JSON, a client that drops the content type has to fail here too
+        if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+            calls["push_rejected"] += 1
+            return JSONResponse(status_code=400, content={"errors": [{"code": "VALIDATION_ERROR", "message": "Expected application/json"}]})
+        messages = await request.json()
+        calls["push_requests"] += 1
+        calls["push_messages"] += len(messages)
+        await expo_latency.wait()
+        return {"data": [{"status": "ok", "id": str(uuid.uuid4())} for _ in messages]}
+
+    @app.get("/_stats")
+    async def stats():
+        return calls
+
+    return app
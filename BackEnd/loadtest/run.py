@@ -0,0 +1,264 @@
+"""Replay user sessions against a locally started backend and report latency per endpoint.
+
+Run from BackEnd/:
+
+    python -m loadtest.run --sessions-per-second 5 --duration 120
+    python -m loadtest.run --database-url postgresql://localhost/rideshare_load --workers 4
+    python -m loadtest.run --redis fake          # no Redis server, forces one worker
+
+Each session signs up, logs in, types a destination into autocomplete, asks
+for a route, posts the trip and polls get_matches, like the app does. ORS and
+Expo are replaced by a local mock with configurable latency. Sessions arrive
+as a Poisson process at the requested rate. Rate limiting is switched off
+unless --rate-limit is given, all sessions come from one address.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import httpx
+import numpy as np
+
+from benchmarks.synthetic import TripGenerator
+from loadtest.mocks import PLACES
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+STARTUP_TIMEOUT_SECONDS = 60
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions-per-second", type=float, default=2.0)
+    parser.add_argument("--duration", type=float, default=60, help="seconds during which sessions start")
+    parser.add_argument("--polls", type=int, default=5, help="get_matches calls per session")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="seconds between polls")
+    parser.add_argument("--think-ms", type=float, default=150, help="pause between keystrokes")
+    parser.add_argument("--cancel-share", type=float, default=0.3, help="share of sessions that cancel at the end")
+    parser.add_argument("--window-hours", type=float, default=2, help="spread of departure times")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    parser.add_argument("--redis", choices=["local", "fake"], default="local")
+    parser.add_argument("--rate-limit", action="store_true", help="keep the rate limiter on")
+    parser.add_argument("--ors-latency-ms", type=float, default=150)
+    parser.add_argument("--expo-latency-ms", type=float, default=80)
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--mock-port", type=int, default=8101)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file, defaults to loadtest/results/<time>.json")
+    return parser.parse_args()
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.failed_sessions = Counter()
+
+    async def call(self, name: str, request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError as e:
+            self.latencies[name].append(time.perf_counter() - started)
+            self.statuses[name][type(e).__name__] += 1
+            raise
+        self.latencies[name].append(time.perf_counter() - started)
+        self.statuses[name][response.status_code] += 1
+        response.raise_for_status()
+        return response
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for name, samples in self.latencies.items():
+            values = np.array(samples) * 1000
+            statuses = self.statuses[name]
+            endpoints[name] = {
+                "requests": len(values),
+                "errors": sum(count for status, count in statuses.items() if not (isinstance(status, int) and status < 400)),
+                "statuses": {str(status): count for status, count in statuses.items()},
+                "p50_ms": round(float(np.percentile(values, 50)), 2),
+                "p95_ms": round(float(np.percentile(values, 95)), 2),
+                "p99_ms": round(float(np.percentile(values, 99)), 2),
+                "max_ms": round(float(values.max()), 2),
+            }
+        total = sum(len(samples) for samples in self.latencies.values())
+        return {
+            "requests": total,
+            "requests_per_second": round(total / elapsed, 2),
+            "failed_sessions": dict(self.failed_sessions),
+            "endpoints": endpoints,
+        }
+
+async def session(client: httpx.AsyncClient, recorder: Recorder, trip: dict, number: int, run_id: str,
+                  rng: random.Random, args) -> None:
+    call = recorder.call
+    stage = "signup"
+    try:
+        email = f"load-{run_id}-{number}@example.com"
+        await call("signup", client.post("/auth/", json={
+            "email": email, "age": rng.randint(18, 60), "gender": trip["gender"], "password": "loadtest",
+        }))
+
+        stage = "token"
+        response = await call("token", client.post("/auth/token", data={"username": email, "password": "loadtest"}))
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        await call("update_push_token", client.post(
+            "/auth/update_push_token", json={"token": f"ExponentPushToken[{run_id}-{number}]"}, headers=headers
+        ))
+
+        # Typing the destination, one request per keystroke after the third
+        stage = "suggestions"
+        place = rng.choice(PLACES)
+        for end in range(3, min(len(place), 8) + 1):
+            await call("suggestions", client.post(
+                "/suggestions_routes/suggestions", json={"encoded_URI_component": quote(place[:end])}
+            ))
+            await asyncio.sleep(args.think_ms / 1000)
+
+        stage = "coordinates"
+        route = trip["route_coordinates"]
+        waypoints = [[route[0]["longitude"], route[0]["latitude"]], [route[-1]["longitude"], route[-1]["latitude"]]]
+        response = await call("coordinates", client.post("/suggestions_routes/coordinates", json={"coordinates": waypoints}))
+        coordinates = response.json()["coordinates"]
+
+        stage = "post_trips"
+        await call("post_trips", client.post("/trips/post_trips", json={
+            "origin_name": trip["origin_name"],
+            "target_name": place,
+            "time": trip["time"].isoformat(),
+            "route_coordinates": [{"latitude": lat, "longitude": lon} for lon, lat in coordinates],
+            "access_token": token,
+        }))
+
+        # The Trips screen: fetch the trip id, then poll its matches
+        stage = "polling"
+        for _ in range(args.polls):
+            response = await call("fetch_trip", client.post("/trips/fetch_trip", headers=headers))
+            await call("get_matches", client.get(
+                "/trips/get_matches", params={"trip_id": response.json()["trip_id"]}, headers=headers
+            ))
+            await asyncio.sleep(args.poll_interval)
+
+        if rng.random() < args.cancel_share:
+            stage = "cancel_trips"
+            await call("cancel_trips", client.post("/trips/cancel_trips", headers=headers))
+    except (httpx.HTTPError, KeyError, ValueError):
+        recorder.failed_sessions[stage] += 1
+
+async def drive(args) -> dict:
+    rng = random.Random(args.seed)
+    generator = TripGenerator(seed=args.seed, window_hours=args.window_hours)
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}", limits=limits, timeout=60) as client:
+        tasks = []
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration:
+            tasks.append(asyncio.create_task(
+                session(client, recorder, generator.trip(), len(tasks), run_id, random.Random(rng.random()), args)
+            ))
+            await asyncio.sleep(rng.expovariate(args.sessions_per_second))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    report = recorder.report(elapsed)
+    report["sessions"] = len(tasks)
+    return report
+
+def wait_until_up(url: str, process: subprocess.Popen) -> None:
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode} during startup")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"{url} did not come up in {STARTUP_TIMEOUT_SECONDS}s")
+
+def start_processes(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mocks = subprocess.Popen(
+        [sys.executable, "-m", "loadtest.serve", "mocks", "--port", str(args.mock_port),
+         "--ors-latency-ms", str(args.ors_latency_ms), "--expo-latency-ms", str(args.expo_latency_ms)],
+        cwd=BACKEND_DIR,
+    )
+
+    env = dict(os.environ)
+    env["SQLALCHEMY_DATABASE_URL"] = args.database_url or \
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='rideshare-load-'), 'load.db')}"
+    env["ORS_BASE_URL"] = mock_url
+    env["EXPO_PUSH_HOST"] = mock_url
+    env.setdefault("orsToken", "loadtest")
+    env.setdefault("SECRET_KEY", "loadtest-secret-key-loadtest-secret-key")
+    if not args.rate_limit:
+        env["RATE_LIMIT_BACKEND"] = "none"
+
+    command = [sys.executable, "-m", "loadtest.serve", "app", "--port", str(args.app_port)]
+    if args.redis == "fake":
+        command.append("--fake-redis")
+    else:
+        command += ["--workers", str(args.workers)]
+    app = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+    try:
+        wait_until_up(f"{mock_url}/_stats", mocks)
+        wait_until_up(f"http://127.0.0.1:{args.app_port}/openapi.json", app)
+    except RuntimeError:
+        stop_processes(mocks, app)
+        raise
+    return mocks, app
+
+def stop_processes(*processes) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def print_report(report: dict) -> None:
+    print(f"{'endpoint':<20}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in sorted(report["endpoints"].items(), key=lambda item: -item[1]["p95_ms"]):
+        print(f"{name:<20}{stats['requests']:>10}{stats['errors']:>8}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    print(f"{report['sessions']} sessions, {report['requests']} requests, {report['requests_per_second']} req/s, "
+          f"failed sessions by stage: {report['failed_sessions'] or 'none'}")
+
+def main():
+    args = parse_args()
+    mocks, app = start_processes(args)
+    try:
+        report = asyncio.run(drive(args))
+        report["upstream_calls"] = httpx.get(f"http://127.0.0.1:{args.mock_port}/_stats").json()
+    finally:
+        stop_processes(app, mocks)
+
+    report["meta"] = {"date": datetime.now(timezone.utc).isoformat(), "args": vars(args)}
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"Saved {output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Processes started by loadtest.run, each on its own port.
+
+    python -m loadtest.serve mocks --port 8101 --ors-latency-ms 150 --expo-latency-ms 80
+    python -m loadtest.serve app --port 8100 --workers 4
+"""
+import argparse
+import uvicorn
+
+def serve_mocks(args) -> None:
+    from loadtest.mocks import Latency, mock_app
+
+    app = mock_app(
+        Latency(args.ors_latency_ms, args.ors_jitter_ms),
+        Latency(args.expo_latency_ms, args.expo_jitter_ms),
+        points=args.route_points,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+def serve_app(args) -> None:
+    if args.fake_redis:
+        # In-process Redis stand-in, only one worker can share it
+        from benchmarks.run import use_fakeredis
+        use_fakeredis()
+        import main
+        uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+    else:
+        uvicorn.run("main:app", host="127.0.0.1", port=args.port, workers=args.workers, log_level="warning")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    mocks = commands.add_parser("mocks", help="OpenRouteService and Expo stand-ins")
+    mocks.add_argument("--port", type=int, required=True)
+    mocks.add_argument("--ors-latency-ms", type=float, default=150)
+    mocks.add_argument("--ors-jitter-ms", type=float, default=50)
+    mocks.add_argument("--expo-latency-ms", type=float, default=80)
+    mocks.add_argument("--expo-jitter-ms", type=float, default=20)
+    mocks.add_argument("--route-points", type=int, default=50)
+
+    app = commands.add_parser("app", help="the backend")
+    app.add_argument("--port", type=int, required=True)
+    app.add_argument("--workers", type=int, default=1)
+    app.add_argument("--fake-redis", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "mocks":
+        serve_mocks(args)
+    else:
+        serve_app(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,52 @@
 from fastapi import FastAPI, Request, status, Depends, HTTPException, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from starlette.middleware.base import BaseHTTPMiddleware
-import schemas, auth, suggestions_routes, trips
+import schemas, auth, suggestions_routes, trips, password_hashing, parallel_match
+from notifications import dispatcher
+from match_events import hub
+import asyncio
 import logging
 import sys
 import time
-from collections import defaultdict
-from database import engine, SessionLocal
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Annotated, Dict
-from sqlalchemy.orm import Session
+from typing import Annotated
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import inspect
 from dependencies import get_db
-from models import User, Trip, Base
-from routine_del_trips import cleanup
+from models import User, Trip
+from rate_limit import RateLimitMiddleware
+from resources import resources
+import metrics
+from routine_del_trips import cleanup, EXPIRY_INTERVAL_SECONDS
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+scheduler = AsyncIOScheduler()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connections and tables first, nothing else runs without them
+    await resources.start()
+    await suggestions_routes.route_cache.drop_legacy()
+    await trips.seed_spatial_index()
+    scheduler.add_job(cleanup, "interval", seconds=EXPIRY_INTERVAL_SECONDS, next_run_time=datetime.now(), max_instances=1)
+    scheduler.start()
+    dispatcher.start()
+    hub.start()
+    # Serving starts now, /health/ready says when the warm-up is done
+    warm_up = asyncio.create_task(resources.warm_up())
+
+    yield
+
+    warm_up.cancel()
+    scheduler.shutdown()
+    await dispatcher.stop()
+    await hub.stop()
+    password_hashing.shutdown()
+    parallel_match.shutdown()
+    await resources.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(auth.router)
 app.include_router(suggestions_routes.router)
@@ -52,51 +79,31 @@ logging.basicConfig(
 # Logger Instance
 logger = logging.getLogger(__name__)
 
-scheduler = AsyncIOScheduler()
-
-@app.on_event("startup")
-async def start_scheduler():
-    scheduler.add_job(cleanup, "interval", minutes=10, next_run_time=datetime.now())
-    scheduler.start()
-
-@app.on_event("shutdown")
-async def shutdown_scheduler():
-    scheduler.shutdown()
-
-class AdvancedMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
-        self.rate_limit_records: Dict[str, float] = defaultdict(float)
-
-    async def dispatch(self, request: Request, call_next):
-
-        path = request.url.path
-        if path in ["/docs", "/openapi.json", "/trips/get_matches", "/auth/token"]:
-            response = await call_next(request)
-            return response
-
-        client_ip = request.client.host
-        current_time = time.time()
-        if current_time - self.rate_limit_records[client_ip] < 1: # 1 request per second limit
-            return Response(content="Rate limit exceeded", status_code=429)
-        
-        self.rate_limit_records[client_ip] = current_time
-        logger.info(f"Request to {path}")
-
-        # Process the request
-        start_time = time.time()
-        response = await call_next(request)
-        process_time = time.time() - start_time
-
-        logger.info(f"Response for {path} took {process_time} seconds")
-        return response
-
-
-
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(auth.get_current_user)]
 
-app.add_middleware(AdvancedMiddleware)
+app.add_middleware(RateLimitMiddleware)
+# Outermost, so refused requests are timed too
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Per worker: with several workers each scrape sees the one that answered
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/health/live", include_in_schema=False)
+async def liveness():
+    # Answering at all means the event loop is not stuck
+    return {"status": "alive"}
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness():
+    checks = await resources.check()
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "ready" if ready else "not ready", **checks},
+    )
 
 @app.get("/", status_code=status.HTTP_200_OK)
 async def user(user: user_dependency, db: db_dependency):
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import redis
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from fastapi import WebSocket
+from resources import resources
+
+logger = logging.getLogger(__name__)
+
+# Every worker publishes match changes here and forwards the ones for users
+# connected to it, so a user hears about a match whichever worker made it
+MATCH_EVENTS_CHANNEL = "match_events"
+
+class MatchEventHub:
+    """Open match sockets of this worker, fed from Redis pub/sub"""
+
+    def __init__(self):
+        self.sockets: Dict[int, Set[WebSocket]] = defaultdict(set)
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for sockets in list(self.sockets.values()):
+            for websocket in list(sockets):
+                await websocket.close()
+
+    def connect(self, user_id: int, websocket: WebSocket) -> None:
+        self.sockets[user_id].add(websocket)
+
+    def disconnect(self, user_id: int, websocket: WebSocket) -> None:
+        sockets = self.sockets.get(user_id)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.sockets[user_id]
+
+    async def publish(self, events: Iterable[Tuple[int, dict]]) -> None:
+        """Send each (user_id, event) to the user on whichever worker holds their socket"""
+        events = list(events)
+        if not events:
+            return
+        try:
+            async with resources.async_redis.pipeline(transaction=False) as pipe:
+                for user_id, event in events:
+                    pipe.publish(MATCH_EVENTS_CHANNEL, json.dumps({"user_id": user_id, "event": event}, default=str))
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Could not publish match events: {e}")
+
+    async def listen(self) -> None:
+        delay = 1
+        while True:
+            try:
+                async with resources.async_redis.pubsub() as pubsub:
+                    await pubsub.subscribe(MATCH_EVENTS_CHANNEL)
+                    delay = 1
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            await self.deliver(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Match event subscription lost, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def deliver(self, message: dict) -> None:
+        for websocket in list(self.sockets.get(message["user_id"], ())):
+            try:
+                await websocket.send_json(message["event"])
+            except Exception:
+                self.disconnect(message["user_id"], websocket)
+
+def match_added(trip_id: int, match: dict) -> dict:
+    return {"type": "match_added", "trip_id": trip_id, "match": match}
+
+def matches_removed(affected: Iterable[Tuple[int, int, int]]) -> List[Tuple[int, dict]]:
+    """Events for the (user_id, trip_id, removed_trip_id) rows match_graph.remove_trips returns"""
+    return [
+        (user_id, {"type": "match_removed", "trip_id": trip_id, "match_id": removed_id})
+        for user_id, trip_id, removed_id in affected
+    ]
+
+def group_updated(members: Iterable[Tuple[int, int, Optional[int]]]) -> List[Tuple[int, dict]]:
+    """Events for (user_id, trip_id, group_id) rows, group_id None once a trip has no group"""
+    return [
+        (user_id, {"type": "group_updated", "trip_id": trip_id, "group_id": group_id})
+        for user_id, trip_id, group_id in members
+    ]
+
+hub = MatchEventHub()
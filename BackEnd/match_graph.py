@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+from typing import Iterable, List, Tuple
+from sqlalchemy import select, delete, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Trip, TripMatch, User
+
+# Matches are computed once, when a trip is inserted, and kept as edges in
+# trip_matches until one of the two trips is cancelled or expires
+
+def insert_ignoring_duplicates(db: AsyncSession):
+    # Two trips posted at once can both find each other, the second insert is a no-op
+    dialect = db.bind.dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(TripMatch).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(TripMatch).on_conflict_do_nothing()
+    return TripMatch.__table__.insert().prefix_with("IGNORE")
+
+async def record_matches(db: AsyncSession, trip: Trip, matches: List[dict]) -> List[int]:
+    """Store the edges between trip and the trips it matched, returns their ids.
+    The caller commits."""
+    distances = {}
+    for match in matches:
+        if match["trip1_id"] == trip.id:
+            distances[match["trip2_id"]] = match["hausdorff_distance_km"]
+        elif match["trip2_id"] == trip.id:
+            distances[match["trip1_id"]] = match["hausdorff_distance_km"]
+
+    if distances:
+        rows = []
+        for other_id, distance in distances.items():
+            rows.append({"trip_id": trip.id, "matched_trip_id": other_id, "hausdorff_distance_km": distance})
+            rows.append({"trip_id": other_id, "matched_trip_id": trip.id, "hausdorff_distance_km": distance})
+        await db.execute(insert_ignoring_duplicates(db), rows)
+
+    await db.execute(update(Trip).where(Trip.id == trip.id).values(matched_at=datetime.now(timezone.utc)))
+    return list(distances)
+
+async def record_batch(db: AsyncSession, trip_ids: List[int], matches: List[dict]) -> None:
+    """record_matches for many new trips at once: every match is an edge, one insert for all.
+    The caller commits."""
+    rows = []
+    for match in matches:
+        distance = match["hausdorff_distance_km"]
+        rows.append({"trip_id": match["trip1_id"], "matched_trip_id": match["trip2_id"], "hausdorff_distance_km": distance})
+        rows.append({"trip_id": match["trip2_id"], "matched_trip_id": match["trip1_id"], "hausdorff_distance_km": distance})
+    if rows:
+        await db.execute(insert_ignoring_duplicates(db), rows)
+
+    await db.execute(update(Trip).where(Trip.id.in_(trip_ids)).values(matched_at=datetime.now(timezone.utc)))
+
+async def load_matches(db: AsyncSession, trip_id: int) -> List[Tuple[Trip, User]]:
+    """Matched trips of trip_id together with their owners, in one query"""
+    result = await db.execute(
+        select(Trip, User)
+        .join(TripMatch, TripMatch.matched_trip_id == Trip.id)
+        .join(User, User.id == Trip.user_id)
+        .where(TripMatch.trip_id == trip_id)
+        .order_by(TripMatch.hausdorff_distance_km)
+    )
+    return result.all()
+
+def losing_matches(trip_ids: List[int]):
+    """(user_id, trip_id, removed_trip_id) of surviving trips matched to one of trip_ids"""
+    return (
+        select(Trip.user_id, TripMatch.trip_id, TripMatch.matched_trip_id)
+        .join(Trip, Trip.id == TripMatch.trip_id)
+        .where(TripMatch.matched_trip_id.in_(trip_ids), TripMatch.trip_id.not_in(trip_ids))
+    )
+
+def edges_of(trip_ids: List[int]):
+    return delete(TripMatch).where(
+        or_(TripMatch.trip_id.in_(trip_ids), TripMatch.matched_trip_id.in_(trip_ids))
+    )
+
+async def remove_trips(db: AsyncSession, trip_ids: Iterable[int]) -> List[Tuple[int, int, int]]:
+    """Delete every edge touching trip_ids. The caller commits.
+
+    Returns (user_id, trip_id, removed_trip_id) for each surviving trip that lost a match."""
+    trip_ids = list(trip_ids)
+    if not trip_ids:
+        return []
+
+    affected = [tuple(row) for row in (await db.execute(losing_matches(trip_ids))).all()]
+    await db.execute(edges_of(trip_ids))
+    return affected
@@ -0,0 +1,150 @@
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
+
+# Latency buckets in seconds, from a cached Redis call up to a slow ORS request
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY: List["Metric"] = []
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Requests, the expiry thread and bcrypt callbacks all record, keep updates whole
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Exposition lines of every label set"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in values]
+
+class Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: count per bucket (the last one is +Inf), then sum
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def time(self, *labels) -> Timer:
+        """Context manager recording how long its body took"""
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self.values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+def render() -> str:
+    """Every metric of this worker in the Prometheus text format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+request_seconds = Histogram(
+    "rideshare_request_seconds", "Time to serve an HTTP request", ("method", "route", "status")
+)
+stage_seconds = Histogram(
+    "rideshare_stage_seconds", "Time spent in one stage of matching or expiry", ("stage",)
+)
+ors_request_seconds = Histogram(
+    "rideshare_ors_request_seconds", "Time of an OpenRouteService call, cache misses only", ("endpoint", "outcome")
+)
+bcrypt_seconds = Histogram(
+    "rideshare_bcrypt_seconds", "Time a password hash or check waited for a thread, and then ran", ("operation", "phase")
+)
+expired_trips_total = Counter("rideshare_expired_trips_total", "Trips deleted by the expiry job")
+
+class MetricsMiddleware:
+    """Times every HTTP request by the route it matched"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template keeps the label set small. Anything refused before routing
+            # (CORS preflights, rate limits) or matching nothing shares one label, whatever
+            # its status, so no client can add series by making up paths
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            request_seconds.observe(time.perf_counter() - start, scope["method"], path, str(status[0]))
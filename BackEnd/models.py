@@ -1,5 +1,5 @@
 from database import Base
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Float, LargeBinary
 from sqlalchemy.orm import relationship
 
 class User(Base):
@@ -20,9 +20,37 @@ class Trip(Base):
     id = Column(Integer, primary_key=True, index=True)
     origin_name = Column(String)
     target_name = Column(String)
-    time = Column(DateTime(timezone=True))
+    # Indexed for the expiry job, which walks trips in departure order
+    time = Column(DateTime(timezone=True), index=True)
     route_coordinates = Column(JSON)
+    # Route projected to metres at insert time (see hausdorff.route_geometry)
+    route_utm_crs = Column(String, nullable=True)
+    route_xy = Column(LargeBinary, nullable=True)
+    route_xy_simplified = Column(LargeBinary, nullable=True)
+    bbox_min_x = Column(Float, nullable=True)
+    bbox_min_y = Column(Float, nullable=True)
+    bbox_max_x = Column(Float, nullable=True)
+    bbox_max_y = Column(Float, nullable=True)
+    # When this trip's edges were written to trip_matches, None if they never were
+    matched_at = Column(DateTime(timezone=True), nullable=True)
     gender = Column(String)
     user_id = Column(Integer, ForeignKey('users.id'))
+    # The car this trip shares, None while it has nobody to ride with
+    group_id = Column(Integer, ForeignKey('carpool_groups.id', ondelete='SET NULL'), nullable=True, index=True)
 
-    user = relationship('User', back_populates='trips')
\ No newline at end of file
+    user = relationship('User', back_populates='trips')
+
+class TripMatch(Base):
+    __tablename__ = 'trip_matches'
+
+    # One row per direction, so all matches of a trip are one primary key range read
+    trip_id = Column(Integer, ForeignKey('trips.id', ondelete='CASCADE'), primary_key=True)
+    matched_trip_id = Column(Integer, ForeignKey('trips.id', ondelete='CASCADE'), primary_key=True, index=True)
+    hausdorff_distance_km = Column(Float)
+
+class CarpoolGroup(Base):
+    __tablename__ = 'carpool_groups'
+
+    id = Column(Integer, primary_key=True, index=True)
+    capacity = Column(Integer)
+    created_at = Column(DateTime(timezone=True))
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import random
+import redis
+import requests
+from dataclasses import dataclass
+from typing import List, Optional
+from exponent_server_sdk import (
+    DeviceNotRegisteredError,
+    MessageRateExceededError,
+    PushClient,
+    PushMessage,
+    PushServerError,
+    PushTicketError,
+)
+from cache import TTLCache
+from resources import resources
+
+logger = logging.getLogger(__name__)
+
+# Expo accepts at most 100 messages per request
+EXPO_BATCH_SIZE = 100
+# Point this at a local mock server to run without Expo
+EXPO_PUSH_HOST = os.getenv("EXPO_PUSH_HOST")
+EXPO_PUSH_TIMEOUT_SECONDS = float(os.getenv("EXPO_PUSH_TIMEOUT_SECONDS", "10"))
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", "10000"))
+# A recipient hears about a given trip at most once in this window
+NOTIFICATION_DEDUPE_TTL_SECONDS = int(os.getenv("NOTIFICATION_DEDUPE_TTL_SECONDS", str(12 * 60 * 60)))
+# After the first alert arrives, wait this long for more to fill the batch
+NOTIFICATION_BATCH_LINGER_SECONDS = 0.05
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_BASE_SECONDS = 1.0
+
+@dataclass
+class MatchAlert:
+    recipient_id: int
+    trip_id: int
+    push_token: str
+    title: str
+    body: str
+
+class NotificationDispatcher:
+    """Queues match alerts and sends them in batches from a background task,
+    so request handlers never wait on Expo"""
+
+    def __init__(self):
+        # The client builds its own session: it sets the JSON headers only on a session it creates
+        self.push_client = PushClient(host=EXPO_PUSH_HOST, timeout=EXPO_PUSH_TIMEOUT_SECONDS)
+        # Local tier of the dedupe check, Redis makes it hold across workers
+        self.recently_sent = TTLCache(maxsize=100_000, ttl=NOTIFICATION_DEDUPE_TTL_SECONDS)
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        if self.task is None:
+            return
+        # Give queued alerts a moment to go out before shutting down
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.queue.qsize()} queued notifications on shutdown")
+        self.task.cancel()
+        self.task = None
+
+    @staticmethod
+    def dedupe_key(alert: MatchAlert) -> str:
+        return f"notified:{alert.recipient_id}:{alert.trip_id}"
+
+    def notify(self, recipient_id: int, trip_id: int, push_token: str, title: str, body: str) -> bool:
+        """Queue an alert about trip_id for recipient_id, unless they already got one"""
+        if self.queue is None:
+            logger.error("Notification dispatcher is not running")
+            return False
+        key = (recipient_id, trip_id)
+        if self.recently_sent.get(key):
+            return False
+        try:
+            self.queue.put_nowait(MatchAlert(recipient_id, trip_id, push_token, title, body))
+        except asyncio.QueueFull:
+            logger.error("Notification queue full, dropping alert")
+            return False
+        # Only once queued, a dropped alert can still be sent by a later match
+        self.recently_sent.set(key, True)
+        return True
+
+    async def claim(self, alerts: List[MatchAlert]) -> List[MatchAlert]:
+        """The alerts no other worker is sending or has sent, marked in Redis as this worker's"""
+        try:
+            async with resources.async_redis.pipeline(transaction=False) as pipe:
+                for alert in alerts:
+                    pipe.set(self.dedupe_key(alert), 1, nx=True, ex=NOTIFICATION_DEDUPE_TTL_SECONDS)
+                claimed = await pipe.execute()
+        except redis.RedisError as exc:
+            logger.warning(f"Notification dedupe falling back to this worker only: {exc}")
+            return alerts
+        return [alert for alert, ok in zip(alerts, claimed) if ok]
+
+    async def release(self, alerts: List[MatchAlert]) -> None:
+        """Forget alerts that never went out, so a later match sends them again"""
+        if not alerts:
+            return
+        for alert in alerts:
+            self.recently_sent.pop((alert.recipient_id, alert.trip_id))
+        try:
+            await resources.async_redis.delete(*[self.dedupe_key(alert) for alert in alerts])
+        except redis.RedisError as exc:
+            logger.warning(f"Could not release {len(alerts)} notification dedupe keys: {exc}")
+
+    async def run(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(NOTIFICATION_BATCH_LINGER_SECONDS)
+            while len(batch) < EXPO_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            claimed = []
+            try:
+                claimed = await self.claim(batch)
+                await self.release(await self.send(claimed))
+            except Exception as e:
+                logger.error(f"Error sending push batch: {e}")
+                await self.release(claimed)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def send(self, alerts: List[MatchAlert]) -> List[MatchAlert]:
+        """Send alerts, retrying what Expo throttles. Returns the alerts that did not go out."""
+        failed = []
+        if not alerts:
+            return failed
+        for attempt in range(NOTIFICATION_MAX_ATTEMPTS):
+            if attempt:
+                # Exponential backoff with jitter so workers do not retry in lockstep
+                delay = NOTIFICATION_RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+            messages = [PushMessage(to=a.push_token, title=a.title, body=a.body, sound="default") for a in alerts]
+            try:
+                tickets = await asyncio.to_thread(self.push_client.publish_multiple, messages)
+            except (PushServerError, requests.exceptions.RequestException) as e:
+                logger.warning(f"Push batch of {len(alerts)} failed (attempt {attempt + 1}): {e}")
+                continue
+
+            # Only messages Expo throttled are worth another go
+            retry = []
+            for alert, ticket in zip(alerts, tickets):
+                try:
+                    ticket.validate_response()
+                except MessageRateExceededError:
+                    retry.append(alert)
+                except DeviceNotRegisteredError:
+                    logger.info(f"Push token of user {alert.recipient_id} is no longer registered")
+                except PushTicketError as e:
+                    logger.error(f"Error sending push to user {alert.recipient_id}: {e}")
+                    failed.append(alert)
+            if not retry:
+                return failed
+            alerts = retry
+
+        logger.error(f"Giving up on {len(alerts)} push notifications")
+        return failed + alerts
+
+dispatcher = NotificationDispatcher()
@@ -0,0 +1,110 @@
+import asyncio
+import importlib.util
+import os
+import time
+import httpx
+from dotenv import load_dotenv
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+from metrics import ors_request_seconds
+
+load_dotenv()
+
+# Point this at a local mock server to run without the real API
+ORS_BASE_URL = os.getenv("ORS_BASE_URL", "https://api.openrouteservice.org")
+ORS_TIMEOUT_SECONDS = float(os.getenv("ORS_TIMEOUT_SECONDS", "10"))
+ORS_MAX_CONNECTIONS = int(os.getenv("ORS_MAX_CONNECTIONS", "20"))
+ORS_MAX_KEEPALIVE = int(os.getenv("ORS_MAX_KEEPALIVE", "10"))
+
+orsToken = os.getenv("orsToken", "")
+
+# HTTP/2 needs the optional h2 package (httpx[http2]), fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_client() -> httpx.AsyncClient:
+    """The worker's long-lived client, connections to ORS are pooled and kept alive"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=ORS_BASE_URL,
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(ORS_TIMEOUT_SECONDS, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=ORS_MAX_CONNECTIONS,
+                max_keepalive_connections=ORS_MAX_KEEPALIVE,
+                keepalive_expiry=30.0,
+            ),
+        )
+    return _client
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+class LeaderCancelled(Exception):
+    """The caller running a shared call went away, its waiters start the call again"""
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one, every caller gets its result"""
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        while True:
+            future = self.calls.get(key)
+            if future is None:
+                break
+            try:
+                # shield: a waiter giving up must not cancel the call others wait on
+                return await asyncio.shield(future)
+            except LeaderCancelled:
+                # The first waiter back runs the call, the others wait on it instead
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # Only this caller was cancelled, not the ones waiting on it
+            future.set_exception(LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            # Mark it retrieved, nobody may be waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+async def request(endpoint: str, method: str, url: str, **kwargs) -> dict:
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        response = await get_client().request(method, url, **kwargs)
+        response.raise_for_status()
+        outcome = "ok"
+        return response.json()
+    finally:
+        ors_request_seconds.observe(time.perf_counter() - started, endpoint, outcome)
+
+async def autocomplete(text: str, size: int) -> dict:
+    return await request(
+        "autocomplete", "GET", "/geocode/autocomplete",
+        params={"api_key": orsToken, "text": text, "size": size},
+    )
+
+async def directions(coordinates: List[List[float]]) -> dict:
+    return await request(
+        "directions", "POST", "/v2/directions/driving-car/geojson",
+        headers={"Authorization": orsToken, "Content-Type": "application/json"},
+        json={"coordinates": coordinates},
+    )
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Iterable, List, Optional, Tuple
+import hausdorff
+
+logger = logging.getLogger(__name__)
+
+PARALLEL_MATCH_WORKERS = int(os.getenv("PARALLEL_MATCH_WORKERS", str(os.cpu_count() or 1)))
+# Below this many candidate pairs, shipping the work to other processes costs more than it saves
+PARALLEL_MATCH_MIN_PAIRS = int(os.getenv("PARALLEL_MATCH_MIN_PAIRS", "2000"))
+# Several shards per process, so one slow shard does not leave the other cores idle
+SHARDS_PER_WORKER = 4
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: forking a process that runs an event loop and threads is not safe
+        _pool = ProcessPoolExecutor(
+            max_workers=PARALLEL_MATCH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def shard_distances(block_name: str, total_points: int, offsets: np.ndarray, keys: List[Tuple[int, str]],
+                    pairs: np.ndarray, threshold: float) -> np.ndarray:
+    """Runs in a pool process: distances of pairs of the routes packed in shared memory"""
+    # Spawned workers share the parent's resource tracker, which unlinks the block once
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        points = np.ndarray((total_points, 2), dtype=np.float64, buffer=block.buf)
+        routes, trees = {}, {}
+        for i in np.unique(pairs).tolist():
+            # Copied out: cached trees keep their points after the block is gone
+            xy = points[offsets[i]:offsets[i + 1]].copy()
+            routes[i] = xy
+            trees[i] = hausdorff.route_tree(keys[i][0], keys[i][1], xy)
+        del points
+    finally:
+        block.close()
+    return hausdorff.pair_distances(routes, trees, pairs, threshold)
+
+async def match_trips(trips, allowed: Iterable[Tuple[int, int]] = None) -> List[dict]:
+    """hausdorff.match_trips, with the pairs spread over the process pool when there are many.
+    allowed limits the comparisons to those pairs of trip ids, see hausdorff.prepare_match."""
+    prepared = hausdorff.prepare_match(trips, allowed)
+    if prepared is None:
+        return []
+    utm_crs, routes, candidates = prepared
+
+    pairs = np.argwhere(np.triu(candidates, k=1))
+    if PARALLEL_MATCH_WORKERS < 2 or len(pairs) < PARALLEL_MATCH_MIN_PAIRS:
+        trees = [hausdorff.route_tree(trip.id, utm_crs, xy) for trip, xy in routes]
+        distances = hausdorff.hausdorff_matrix(
+            [xy for _, xy in routes], candidates, hausdorff.CARPOOL_THRESHOLD_M, trees
+        )
+        return hausdorff.match_results(utm_crs, routes, distances)
+
+    # Every route in one shared block, workers get its name and offsets instead of pickled arrays
+    offsets = np.cumsum([0] + [len(xy) for _, xy in routes])
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(offsets[-1]) * 2 * 8))
+    try:
+        np.ndarray((int(offsets[-1]), 2), dtype=np.float64, buffer=block.buf)[:] = np.concatenate(
+            [xy for _, xy in routes]
+        )
+        keys = [(trip.id, utm_crs) for trip, _ in routes]
+
+        loop = asyncio.get_running_loop()
+        shards = np.array_split(pairs, min(len(pairs), PARALLEL_MATCH_WORKERS * SHARDS_PER_WORKER))
+        results = await asyncio.gather(*[
+            loop.run_in_executor(
+                get_pool(), shard_distances, block.name, int(offsets[-1]), offsets, keys, shard,
+                hausdorff.CARPOOL_THRESHOLD_M,
+            )
+            for shard in shards
+        ])
+    finally:
+        block.close()
+        block.unlink()
+
+    distances = np.full((len(routes), len(routes)), np.inf)
+    np.fill_diagonal(distances, 0)
+    distances[pairs[:, 0], pairs[:, 1]] = np.concatenate(results)
+    distances = np.minimum(distances, distances.T)
+    return hausdorff.match_results(utm_crs, routes, distances)
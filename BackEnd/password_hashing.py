@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+from metrics import bcrypt_seconds
+
+logger = logging.getLogger(__name__)
+
+# bcrypt releases the GIL while hashing, so a thread pool runs hashes in parallel
+# across cores while the event loop keeps serving other requests
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(os.cpu_count() or 2)))
+# Hashes waiting or running before new signups/logins are turned away with a 503
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "64"))
+# Log a warning when a request waited this long for a free worker
+BCRYPT_SLOW_WAIT_SECONDS = 0.5
+
+bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+# Only touched from the event loop thread
+_pending = 0
+
+def _new_stats() -> dict:
+    return {"calls": 0, "rejected": 0, "wait_seconds": 0.0, "run_seconds": 0.0, "max_run_seconds": 0.0}
+
+_stats = {"hash": _new_stats(), "verify": _new_stats()}
+
+def pool_stats() -> dict:
+    return {"pending": _pending, "workers": BCRYPT_WORKERS, **{op: dict(s) for op, s in _stats.items()}}
+
+async def _run(op: str, fn, *args):
+    global _pending
+    stats = _stats[op]
+    if _pending >= BCRYPT_MAX_PENDING:
+        stats["rejected"] += 1
+        logger.warning(f"Password {op} rejected, {_pending} already pending")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again",
+            headers={"Retry-After": "1"},
+        )
+
+    def timed():
+        started = time.perf_counter()
+        return fn(*args), started, time.perf_counter()
+
+    _pending += 1
+    queued = time.perf_counter()
+    try:
+        result, started, finished = await asyncio.get_running_loop().run_in_executor(_executor, timed)
+    finally:
+        _pending -= 1
+
+    wait = started - queued
+    run = finished - started
+    stats["calls"] += 1
+    stats["wait_seconds"] += wait
+    stats["run_seconds"] += run
+    stats["max_run_seconds"] = max(stats["max_run_seconds"], run)
+    bcrypt_seconds.observe(wait, op, "wait")
+    bcrypt_seconds.observe(run, op, "run")
+    if wait > BCRYPT_SLOW_WAIT_SECONDS:
+        logger.warning(f"Password {op} waited {wait:.3f}s for a worker")
+    return result
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", bcrypt_context.hash, password)
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await _run("verify", bcrypt_context.verify, password, hashed_password)
+
+def shutdown() -> None:
+    _executor.shutdown(wait=False, cancel_futures=True)
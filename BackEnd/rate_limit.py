@@ -0,0 +1,178 @@
+import logging
+import math
+import os
+import time
+import redis
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException
+from security import verify_token
+from resources import resources
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class Policy:
+    """Token bucket: rate requests per second on average, up to burst at once"""
+    rate: float
+    burst: int
+
+DEFAULT_POLICY = Policy(rate=1.0, burst=5)
+
+# None means the path is not limited
+ROUTE_POLICIES: Dict[str, Optional[Policy]] = {
+    "/docs": None,
+    "/openapi.json": None,
+    "/metrics": None,
+    "/health/live": None,
+    "/health/ready": None,
+    # Login is keyed by IP, slow enough to make guessing passwords pointless
+    "/auth/token": Policy(rate=0.2, burst=5),
+    # Autocomplete fires as the user types
+    "/suggestions_routes/suggestions": Policy(rate=5.0, burst=10),
+    "/trips/get_matches": Policy(rate=2.0, burst=10),
+}
+
+# Buckets kept per worker, least recently used ones are dropped past this
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# "redis" shares the buckets between workers, "memory" keeps them per worker,
+# "none" turns limiting off (load tests, where every client shares one address)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+class LocalBuckets:
+    """Token buckets of this worker, bounded in number"""
+
+    def __init__(self, maxsize: int = RATE_LIMIT_MAX_KEYS):
+        self.maxsize = maxsize
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def hit(self, key: str, policy: Policy, now: float) -> Tuple[bool, float]:
+        """Take a token for key, returns whether there was one and how long until there is"""
+        tokens, last = self.buckets.pop(key, (policy.burst, now))
+        tokens = min(policy.burst, tokens + (now - last) * policy.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.maxsize:
+            self.buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / policy.rate
+
+    def refund(self, key: str, policy: Policy) -> None:
+        """Give back the token of a hit that was refused elsewhere"""
+        entry = self.buckets.get(key)
+        if entry is not None:
+            self.buckets[key] = (min(policy.burst, entry[0] + 1), entry[1])
+
+class RedisBuckets:
+    """Token buckets shared by every worker, each hit is one atomic script call"""
+
+    # KEYS: bucket  ARGV: rate, burst, now
+    # Returns {allowed, milliseconds until the next token}
+    HIT_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+-- A bucket left alone this long is full again, Redis can drop it
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, wait}
+"""
+
+    async def hit(self, key: str, policy: Policy, now: float) -> Tuple[bool, float]:
+        allowed, wait_ms = await resources.script(self.HIT_SCRIPT)(keys=[f"rate_limit:{key}"], args=[policy.rate, policy.burst, now])
+        return bool(allowed), wait_ms / 1000
+
+class RateLimiter:
+    def __init__(self, shared: Optional[RedisBuckets] = None, maxsize: int = RATE_LIMIT_MAX_KEYS):
+        self.local = LocalBuckets(maxsize)
+        self.shared = shared
+
+    @staticmethod
+    def policy_for(path: str) -> Optional[Policy]:
+        return ROUTE_POLICIES.get(path, DEFAULT_POLICY)
+
+    async def hit(self, key: str, policy: Policy) -> Tuple[bool, float]:
+        now = time.time()
+        # This worker sees a subset of the key's requests, so its bucket never holds
+        # fewer tokens than the shared one: a local refusal is final and costs no round trip
+        allowed, retry_after = self.local.hit(key, policy, now)
+        if not allowed or self.shared is None:
+            return allowed, retry_after
+        try:
+            shared_allowed, shared_retry_after = await self.shared.hit(key, policy, now)
+        except redis.RedisError as e:
+            logger.warning(f"Shared rate limit unavailable, limiting per worker: {e}")
+            return allowed, retry_after
+        if not shared_allowed:
+            # The request is refused, it must not cost a local token too or this
+            # worker would end up refusing on its own what the shared tier allows
+            self.local.refund(key, policy)
+        return shared_allowed, shared_retry_after
+
+def create_rate_limiter(backend: str = None) -> Optional[RateLimiter]:
+    backend = backend or RATE_LIMIT_BACKEND
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return RateLimiter()
+    if backend == "redis":
+        return RateLimiter(RedisBuckets())
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+def client_key(scope) -> str:
+    """Signed-in users are limited per account, everyone else per address"""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                try:
+                    return f"user:{verify_token(token)['id']}"
+                except HTTPException:
+                    pass
+            break
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+class RateLimitMiddleware:
+    """Plain ASGI middleware, responses pass through untouched"""
+
+    def __init__(self, app, limiter: Optional[RateLimiter] = None):
+        self.app = app
+        self.limiter = limiter or create_rate_limiter()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.limiter is None:
+            return await self.app(scope, receive, send)
+
+        path = scope["path"]
+        policy = self.limiter.policy_for(path)
+        if policy is not None:
+            key = f"{client_key(scope)}:{path if path in ROUTE_POLICIES else '*'}"
+            allowed, retry_after = await self.limiter.hit(key, policy)
+            if not allowed:
+                await send({
+                    "type": "http.response.start",
+                    "status": 429,
+                    "headers": [
+                        (b"content-type", b"text/plain; charset=utf-8"),
+                        (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+                    ],
+                })
+                await send({"type": "http.response.body", "body": b"Rate limit exceeded"})
+                return
+
+        await self.app(scope, receive, send)
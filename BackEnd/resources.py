@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Optional
+import redis.asyncio
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from dotenv import load_dotenv
+import database
+import ors_client
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# A readiness probe that waits longer than this on Redis or the database reports not ready
+READINESS_TIMEOUT_SECONDS = float(os.getenv("READINESS_TIMEOUT_SECONDS", "2"))
+
+class Resources:
+    """Connections and caches shared by every module of this worker.
+
+    Nothing connects at import: start() builds the engines and the Redis pool and
+    close() tears them down, so modules read the attributes when they make a call
+    rather than keeping their own reference. Redis is only used from the event loop,
+    through one asyncio pool."""
+
+    def __init__(self):
+        self.engine = None
+        self.async_engine = None
+        self.session: Optional[sessionmaker] = None
+        self.async_session: Optional[async_sessionmaker] = None
+        self.async_redis: Optional[redis.asyncio.Redis] = None
+        self.scripts: Dict[str, object] = {}
+        self.transformers: Dict[str, object] = {}
+        self.ready = False
+
+    @property
+    def http(self):
+        return ors_client.get_client()
+
+    def script(self, source: str):
+        """The Lua script registered on the current Redis client"""
+        script = self.scripts.get(source)
+        if script is None:
+            script = self.scripts[source] = self.async_redis.register_script(source)
+        return script
+
+    def transformer(self, utm_crs: str):
+        # Building a Transformer is far more expensive than using one, keep one per zone
+        transformer = self.transformers.get(utm_crs)
+        if transformer is None:
+            import pyproj
+            transformer = self.transformers[utm_crs] = pyproj.Transformer.from_crs(
+                "EPSG:4326", utm_crs, always_xy=True
+            )
+        return transformer
+
+    async def start(self) -> None:
+        self.engine, self.async_engine = database.create_engines()
+        self.session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.async_session = async_sessionmaker(
+            self.async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+        self.async_redis = redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool.from_url(REDIS_URL))
+        # Blocking DDL, off the loop
+        await asyncio.to_thread(database.create_tables, self.engine)
+
+    async def warm_up(self) -> None:
+        """Load pyproj and scipy and build the transformers, then report ready.
+        Runs after startup, so liveness answers meanwhile. The match processes
+        still start on the first large match."""
+        import hausdorff
+
+        try:
+            await asyncio.to_thread(hausdorff.warm_up)
+        except Exception as e:
+            logger.error(f"Warm-up failed: {e}")
+            return
+        self.ready = True
+        logger.info("Worker warmed up")
+
+    async def check(self) -> dict:
+        """Status of each dependency a request needs"""
+        async def redis_ok():
+            await self.async_redis.ping()
+
+        async def database_ok():
+            async with self.async_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+
+        checks = {"warmed_up": self.ready}
+        for name, probe in (("redis", redis_ok), ("database", database_ok)):
+            try:
+                await asyncio.wait_for(probe(), READINESS_TIMEOUT_SECONDS)
+                checks[name] = True
+            except Exception as e:
+                logger.warning(f"Readiness check of {name} failed: {e}")
+                checks[name] = False
+        return checks
+
+    async def close(self) -> None:
+        self.ready = False
+        await ors_client.close_client()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+            self.engine.dispose()
+            self.engine = self.async_engine = self.session = self.async_session = None
+        if self.async_redis is not None:
+            await self.async_redis.aclose()
+            self.async_redis = None
+        self.scripts.clear()
+
+resources = Resources()
@@ -0,0 +1,184 @@
+import math
+import os
+import struct
+import time
+import zlib
+import logging
+import numpy as np
+import redis
+from typing import List, Optional, Tuple
+from resources import resources
+
+logger = logging.getLogger(__name__)
+
+# Requests whose endpoints fall in the same grid cells share one cached route
+ROUTE_CACHE_GRID_M = float(os.getenv("ROUTE_CACHE_GRID_M", "25"))
+# Idle entries expire after this, every hit extends it
+ROUTE_CACHE_TTL_SECONDS = int(os.getenv("ROUTE_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+# Least recently used routes are evicted once the stored values pass this size
+ROUTE_CACHE_MAX_BYTES = int(os.getenv("ROUTE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+METRES_PER_DEGREE = 111320
+# Coordinates are stored as integer micro-degrees (about 0.1 m)
+COORD_SCALE = 1e6
+
+class RouteCache:
+    """Directions responses in Redis, compact and bounded in size.
+
+    route_cache:<cells>  compressed route, with a sliding TTL
+    route_cache:index    sorted set of cells by last use, for LRU eviction
+    route_cache:sizes    hash of cells -> stored bytes
+    route_cache:bytes    total stored bytes
+    route_cache:stats    hash of hits, misses, stores and evictions
+    """
+
+    PREFIX = "route_cache:"
+    INDEX_KEY = "route_cache:index"
+    SIZES_KEY = "route_cache:sizes"
+    BYTES_KEY = "route_cache:bytes"
+    STATS_KEY = "route_cache:stats"
+    # Unbounded hash the routes and suggestions used to be kept in, nothing reads it any more
+    LEGACY_KEY = "trips"
+
+    # Read an entry and, on a hit, mark it as just used and extend its TTL, in one call.
+    # KEYS: entry, index, stats
+    # ARGV: member, now, ttl
+    LOOKUP_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    redis.call('HINCRBY', KEYS[3], 'misses', 1)
+    return false
+end
+redis.call('HINCRBY', KEYS[3], 'hits', 1)
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return value
+"""
+
+    # Store one entry, then drop entries that expired and the least recently used
+    # ones until the total is back under the ceiling, all in one atomic call.
+    # KEYS: index, sizes, bytes, stats
+    # ARGV: prefix, member, value, now, ttl, max_bytes
+    STORE_SCRIPT = """
+local prefix, member, value = ARGV[1], ARGV[2], ARGV[3]
+local now, ttl, max_bytes = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+
+local function drop(m)
+    local size = tonumber(redis.call('HGET', KEYS[2], m) or '0')
+    redis.call('DEL', prefix .. m)
+    redis.call('ZREM', KEYS[1], m)
+    redis.call('HDEL', KEYS[2], m)
+    redis.call('DECRBY', KEYS[3], size)
+end
+
+for _, m in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - ttl)) do
+    drop(m)
+end
+drop(member)
+
+redis.call('SET', prefix .. member, value, 'EX', ttl)
+redis.call('ZADD', KEYS[1], now, member)
+redis.call('HSET', KEYS[2], member, #value)
+local total = redis.call('INCRBY', KEYS[3], #value)
+
+local evicted = 0
+while total > max_bytes do
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+    if not oldest or oldest == member then
+        break
+    end
+    drop(oldest)
+    evicted = evicted + 1
+    total = tonumber(redis.call('GET', KEYS[3]))
+end
+
+redis.call('HINCRBY', KEYS[4], 'stores', 1)
+redis.call('HINCRBY', KEYS[4], 'evictions', evicted)
+return evicted
+"""
+
+    def __init__(self, grid_m: float = ROUTE_CACHE_GRID_M, ttl: int = ROUTE_CACHE_TTL_SECONDS,
+                 max_bytes: int = ROUTE_CACHE_MAX_BYTES):
+        self.grid_m = grid_m
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def cell_key(self, coordinates: List[List[float]]) -> str:
+        """Grid cells of the requested [lon, lat] waypoints"""
+        lat_step = self.grid_m / METRES_PER_DEGREE
+        cells = []
+        for lon, lat in coordinates:
+            lat_cell = round(lat / lat_step)
+            # Longitude cells shrink with latitude, size them from the snapped latitude
+            # so every point in a cell gets the same step
+            lon_step = lat_step / max(math.cos(math.radians(lat_cell * lat_step)), 1e-6)
+            cells.append(f"{round(lon / lon_step)},{lat_cell}")
+        return "|".join(cells)
+
+    @staticmethod
+    def encode(coords: List[List[float]], duration: float) -> bytes:
+        # Delta-encoded integer micro-degrees compress far better than raw floats
+        points = np.rint(np.asarray(coords, dtype=np.float64)[:, :2] * COORD_SCALE).astype(np.int64)
+        deltas = np.diff(points, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).astype('<i4')
+        return zlib.compress(struct.pack('<d', duration) + deltas.tobytes())
+
+    @staticmethod
+    def decode(value: bytes) -> Tuple[List[List[float]], float]:
+        raw = zlib.decompress(value)
+        (duration,) = struct.unpack_from('<d', raw)
+        deltas = np.frombuffer(raw, dtype='<i4', offset=8).reshape(-1, 2)
+        coords = np.cumsum(deltas, axis=0, dtype=np.int64) / COORD_SCALE
+        return coords.tolist(), duration
+
+    async def get(self, coordinates: List[List[float]]) -> Optional[Tuple[List[List[float]], float]]:
+        """Cached route and duration, None on a miss or when Redis is unavailable"""
+        member = self.cell_key(coordinates)
+        try:
+            value = await resources.script(self.LOOKUP_SCRIPT)(
+                keys=[self.PREFIX + member, self.INDEX_KEY, self.STATS_KEY],
+                args=[member, time.time(), self.ttl],
+            )
+        except redis.RedisError as exc:
+            logger.warning(f"Route cache unavailable: {exc}")
+            return None
+        return None if value is None else self.decode(value)
+
+    async def set(self, coordinates: List[List[float]], coords: List[List[float]], duration: float) -> None:
+        # The route is already fetched, failing to cache it must not fail the request
+        try:
+            await resources.script(self.STORE_SCRIPT)(
+                keys=[self.INDEX_KEY, self.SIZES_KEY, self.BYTES_KEY, self.STATS_KEY],
+                args=[self.PREFIX, self.cell_key(coordinates), self.encode(coords, duration),
+                      time.time(), self.ttl, self.max_bytes],
+            )
+        except redis.RedisError as exc:
+            logger.warning(f"Route cache unavailable: {exc}")
+
+    async def drop_legacy(self) -> None:
+        """Free what the old cache stored, so max_bytes bounds all the cached routes.
+        UNLINK frees it in the background and is a no-op once the hash is gone."""
+        try:
+            if await resources.async_redis.unlink(self.LEGACY_KEY):
+                logger.info(f"Dropped the legacy '{self.LEGACY_KEY}' route hash")
+        except redis.RedisError as exc:
+            logger.warning(f"Could not drop the legacy route hash: {exc}")
+
+    async def stats(self) -> dict:
+        async with resources.async_redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.STATS_KEY)
+            pipe.zcard(self.INDEX_KEY)
+            pipe.get(self.BYTES_KEY)
+            counters, entries, stored_bytes = await pipe.execute()
+        counters = {k.decode(): int(v) for k, v in counters.items()}
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "stores": counters.get("stores", 0),
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": int(stored_bytes or 0),
+            "max_bytes": self.max_bytes,
+            "grid_m": self.grid_m,
+        }
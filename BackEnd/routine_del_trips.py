@@ -1,31 +1,110 @@
-from sqlalchemy.orm import Session
-from dependencies import get_db
-from database import SessionLocal
+from sqlalchemy import select, delete
+import asyncio
 import logging
+import os
+import uuid
 import redis
 from models import Trip
+from hausdorff import forget_trips
+from spatial_index import spatial_index
+import match_graph
+import carpool_groups
+from match_events import hub, matches_removed, group_updated
+from metrics import stage_seconds, expired_trips_total
+from resources import resources
 from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
 
-def cleanup():
-    db = SessionLocal()
+EXPIRY_INTERVAL_SECONDS = int(os.getenv("EXPIRY_INTERVAL_SECONDS", "60"))
+# Trips deleted per transaction, and at most this many batches per run so a
+# backlog is worked off over several runs instead of in one long one
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+EXPIRY_MAX_BATCHES = int(os.getenv("EXPIRY_MAX_BATCHES", "20"))
+
+# Only the worker holding this key runs expiry. It renews the key every run, if it
+# dies the key lapses after a few missed runs and another worker takes over.
+LEADER_KEY = "trip_expiry:leader"
+LEADER_TTL_MS = EXPIRY_INTERVAL_SECONDS * 3 * 1000
+LEADER_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if not holder or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+worker_id = uuid.uuid4().hex
+
+async def is_leader() -> bool:
     try:
-        now = datetime.now(timezone.utc)
-        expired_trips = db.query(Trip).filter(Trip.time <= now).all()
-        expired_ids = [trip.id for trip in expired_trips]
-
-        if expired_ids:
-                for t_id in expired_ids:
-                    redis_client.zrem('trips_geo_hash', f"{t_id}:start")
-                    redis_client.zrem('trips_geo_hash', f"{t_id}:end")
-
-        deleted_count = db.query(Trip).filter(Trip.time <= now).delete()
-        db.commit()
-        logger.info(f"Deleted {deleted_count} rows at {now}")
-    except Exception as e:
-        logger.error(f"Cleanup failed: {e}")
-        db.rollback()
-    finally:
-        db.close()
+        return bool(await resources.script(LEADER_SCRIPT)(keys=[LEADER_KEY], args=[worker_id, LEADER_TTL_MS]))
+    except redis.RedisError as e:
+        # Batches lock their rows, running on several workers is safe, only wasteful
+        logger.warning(f"Expiry leader election unavailable, running anyway: {e}")
+        return True
+
+def expire_batch(db, now: datetime):
+    """Delete up to EXPIRY_BATCH_SIZE departed trips, oldest first"""
+    expired_trips = db.execute(
+        select(Trip.id, Trip.time)
+        .where(Trip.time <= now)
+        .order_by(Trip.time)
+        .limit(EXPIRY_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    ).all()
+    expired_ids = [trip_id for trip_id, _ in expired_trips]
+    if not expired_ids:
+        return expired_trips, [], []
+
+    group_ids = db.execute(carpool_groups.groups_of(expired_ids)).scalars().all()
+    affected = [tuple(row) for row in db.execute(match_graph.losing_matches(expired_ids)).all()]
+    db.execute(match_graph.edges_of(expired_ids))
+    # Delete exactly the rows selected, not whatever matches the predicate by now
+    db.execute(delete(Trip).where(Trip.id.in_(expired_ids)))
+    db.commit()
+    return expired_trips, affected, group_ids
+
+def expire_trips():
+    """Blocking part of cleanup, runs in a worker thread. Returns the (trip_id, departure)
+    pairs deleted, the matches they took with them and the groups they left."""
+    now = datetime.now(timezone.utc)
+    expired, affected, group_ids = [], [], set()
+    with resources.session() as db:
+        for _ in range(EXPIRY_MAX_BATCHES):
+            try:
+                with stage_seconds.time("expiry_batch"):
+                    expired_trips, batch_affected, batch_groups = expire_batch(db, now)
+            except Exception as e:
+                logger.error(f"Cleanup batch failed: {e}")
+                db.rollback()
+                break
+            expired.extend(expired_trips)
+            expired_trips_total.inc(amount=len(expired_trips))
+            affected.extend(batch_affected)
+            group_ids.update(batch_groups)
+            if len(expired_trips) < EXPIRY_BATCH_SIZE:
+                break
+
+    logger.info(f"Deleted {len(expired)} rows at {now}")
+    return expired, affected, group_ids
+
+async def cleanup():
+    if not await is_leader():
+        return
+    expired, affected, group_ids = await asyncio.to_thread(expire_trips)
+    # Back on the event loop, which owns the KD-tree cache, the spatial index and the sockets
+    forget_trips([trip_id for trip_id, _ in expired])
+    await hub.publish(matches_removed(affected))
+
+    if group_ids:
+        # Lone members are placed again, which goes through the async matching code
+        async with resources.async_session() as db:
+            regrouped = await carpool_groups.settle_groups(db, group_ids)
+            await db.commit()
+            if regrouped:
+                await hub.publish(group_updated((await db.execute(carpool_groups.trip_groups(regrouped))).all()))
+
+    # Last: Redis may be down, which is also when is_leader lets every worker in
+    await spatial_index.discard(expired)
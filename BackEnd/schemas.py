@@ -35,6 +35,7 @@ class Trips(BaseModel):
     access_token: str
 
 class Trips_Return_Response(BaseModel):
+    id: int
     origin_name: str
     target_name: str
     time: datetime
@@ -52,4 +53,7 @@ class UserResponse(BaseModel):
     push_token: Optional[str] = None
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class Bulk_Trips(BaseModel):
+    trips: List[Trips]
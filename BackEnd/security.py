@@ -0,0 +1,67 @@
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+from starlette import status
+from dotenv import load_dotenv
+from cache import TTLCache
+import hashlib
+import jwt
+import os
+import time
+
+load_dotenv()
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+# Older .env files spell it AlGORITHM
+ALGORITHM = os.getenv("ALGORITHM") or os.getenv("AlGORITHM") or "HS256"
+
+# Verified claims, keyed by the token's digest so raw tokens are never kept around.
+# Polling clients present the same token every call and skip the signature check.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+_claims_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl='auth/token')
+
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def create_access_token(username: str, user_id: int) -> str:
+    encode = {'sub': username, 'id': user_id}
+    return jwt.encode(encode, SECRET_KEY, ALGORITHM)
+
+def verify_token(token: str) -> dict:
+    """Claims of a valid token, raises a 401 otherwise"""
+    key = hashlib.sha256(token.encode()).digest()
+    claims = _claims_cache.get(key)
+    if claims is not None:
+        return claims
+
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
+    except jwt.PyJWTError:
+        raise credentials_exception
+
+    if claims.get('sub') is None or claims.get('id') is None:
+        raise credentials_exception
+
+    # Never serve a token from the cache past its own expiry
+    ttl = TOKEN_CACHE_TTL_SECONDS
+    if 'exp' in claims:
+        ttl = min(ttl, claims['exp'] - time.time())
+    if ttl > 0:
+        _claims_cache.set(key, claims, ttl)
+    return claims
+
+def token_cache_stats() -> dict:
+    return _claims_cache.stats()
+
+async def get_current_claims(token: str = Depends(oauth2_scheme)) -> dict:
+    return verify_token(token)
+
+async def get_current_user_id(claims: dict = Depends(get_current_claims)) -> int:
+    return claims['id']
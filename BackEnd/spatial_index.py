@@ -0,0 +1,240 @@
+import logging
+import math
+import os
+import redis
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Set, Tuple
+from resources import resources
+
+logger = logging.getLogger(__name__)
+
+# Trips are indexed per 30 minute departure window, so a lookup only has to
+# search its own window and the two next to it to cover the ±30 minute rule
+GEO_BUCKET_SECONDS = 30 * 60
+# Redis buckets expire this long after their window closes, cleanup normally empties them first
+GEO_BUCKET_GRACE_SECONDS = 60 * 60
+GEO_SEARCH_RADIUS_KM = 2
+
+# Same earth radius as Redis GEO, so both backends agree on what "within r" means
+EARTH_RADIUS_M = 6372797.560856
+
+Point = Tuple[float, float]  # (longitude, latitude)
+
+def geo_bucket(departure: datetime) -> int:
+    # SQLite hands back naive datetimes, they are stored as UTC
+    if departure.tzinfo is None:
+        departure = departure.replace(tzinfo=timezone.utc)
+    return int(departure.timestamp() // GEO_BUCKET_SECONDS)
+
+def haversine_m(a: Point, b: Point) -> float:
+    lon1, lat1, lon2, lat2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+class SpatialIndex(ABC):
+    """Start/end points of active trips, searchable by departure window. Used from the event loop only."""
+
+    # Whether the index outlives this process, one that does not is seeded from the database at startup
+    persistent = True
+
+    @abstractmethod
+    async def match_candidates(self, trip_id: int, start: Point, end: Point, departure: datetime,
+                         radius_km: float = GEO_SEARCH_RADIUS_KM) -> List[int]:
+        """Index the trip if it is not yet, then return the other trips departing in a
+        neighbouring window that start within radius_km of start and end within it of end"""
+
+    @abstractmethod
+    async def add_many(self, trips: Iterable[Tuple[int, Point, Point, datetime]]) -> None:
+        """Index (trip_id, start, end, departure) tuples without searching"""
+
+    async def match_candidates_many(self, trips: Iterable[Tuple[int, Point, Point, datetime]],
+                                    radius_km: float = GEO_SEARCH_RADIUS_KM) -> List[List[int]]:
+        """match_candidates for each (trip_id, start, end, departure), in order. Every pair
+        among the trips themselves is reported once, by whichever of the two comes later."""
+        return [await self.match_candidates(*trip, radius_km=radius_km) for trip in trips]
+
+    @abstractmethod
+    async def remove(self, trips: Iterable[Tuple[int, datetime]]) -> None:
+        """Remove (trip_id, departure) pairs from the index"""
+
+    async def discard(self, trips: Iterable[Tuple[int, datetime]]) -> None:
+        """remove, for trips already deleted from the database: failing must not undo the
+        rest of the caller's work. A trip left behind is only a candidate that no row matches,
+        and its bucket expires anyway."""
+        try:
+            await self.remove(trips)
+        except redis.RedisError as e:
+            logger.warning(f"Could not remove trips from the spatial index: {e}")
+
+class RedisSpatialIndex(SpatialIndex):
+    # One round trip per lookup: index the trip in its own bucket if it is not there yet,
+    # search every bucket around both ends and return only the trips near at both.
+    # KEYS: the trip's own bucket, then the neighbouring buckets
+    # ARGV: trip_id, start_lon, start_lat, end_lon, end_lat, radius_km, expire_at
+    MATCH_SCRIPT = """
+local trip_id = ARGV[1]
+if not redis.call('ZSCORE', KEYS[1], trip_id .. ':start') then
+    redis.call('GEOADD', KEYS[1], ARGV[2], ARGV[3], trip_id .. ':start', ARGV[4], ARGV[5], trip_id .. ':end')
+    redis.call('EXPIREAT', KEYS[1], ARGV[7])
+end
+
+local near_start = {}
+for i = 1, #KEYS do
+    for _, member in ipairs(redis.call('GEOSEARCH', KEYS[i], 'FROMLONLAT', ARGV[2], ARGV[3], 'BYRADIUS', ARGV[6], 'km')) do
+        local id, side = string.match(member, '^(.+):(%a+)$')
+        if side == 'start' and id ~= trip_id then
+            near_start[id] = true
+        end
+    end
+end
+
+local matches = {}
+for i = 1, #KEYS do
+    for _, member in ipairs(redis.call('GEOSEARCH', KEYS[i], 'FROMLONLAT', ARGV[4], ARGV[5], 'BYRADIUS', ARGV[6], 'km')) do
+        local id, side = string.match(member, '^(.+):(%a+)$')
+        if side == 'end' and near_start[id] then
+            matches[#matches + 1] = id
+            near_start[id] = nil
+        end
+    end
+end
+return matches
+"""
+
+    @staticmethod
+    def bucket_key(bucket: int) -> str:
+        return f"trips_geo:{bucket}"
+
+    @staticmethod
+    def bucket_expiry(bucket: int) -> int:
+        return (bucket + 1) * GEO_BUCKET_SECONDS + GEO_BUCKET_GRACE_SECONDS
+
+    async def match_candidates(self, trip_id, start, end, departure, radius_km=GEO_SEARCH_RADIUS_KM):
+        bucket = geo_bucket(departure)
+        keys = [self.bucket_key(bucket), self.bucket_key(bucket - 1), self.bucket_key(bucket + 1)]
+        expire_at = self.bucket_expiry(bucket)
+        return [int(tid) for tid in await resources.script(self.MATCH_SCRIPT)(
+            keys=keys,
+            args=[trip_id, *start, *end, radius_km, expire_at],
+        )]
+
+    async def match_candidates_many(self, trips, radius_km=GEO_SEARCH_RADIUS_KM):
+        # The same script per trip, all in one round trip
+        match_script = resources.script(self.MATCH_SCRIPT)
+        async with resources.async_redis.pipeline(transaction=False) as pipe:
+            for trip_id, start, end, departure in trips:
+                bucket = geo_bucket(departure)
+                await match_script(
+                    keys=[self.bucket_key(bucket), self.bucket_key(bucket - 1), self.bucket_key(bucket + 1)],
+                    args=[trip_id, *start, *end, radius_km, self.bucket_expiry(bucket)],
+                    client=pipe,
+                )
+            return [[int(tid) for tid in found] for found in await pipe.execute()]
+
+    async def add_many(self, trips):
+        async with resources.async_redis.pipeline(transaction=False) as pipe:
+            buckets = set()
+            for trip_id, start, end, departure in trips:
+                bucket = geo_bucket(departure)
+                buckets.add(bucket)
+                pipe.geoadd(self.bucket_key(bucket), [*start, f"{trip_id}:start", *end, f"{trip_id}:end"])
+            for bucket in buckets:
+                pipe.expireat(self.bucket_key(bucket), self.bucket_expiry(bucket))
+            await pipe.execute()
+
+    async def remove(self, trips):
+        # One round trip however many trips expire together
+        async with resources.async_redis.pipeline(transaction=False) as pipe:
+            for trip_id, departure in trips:
+                pipe.zrem(self.bucket_key(geo_bucket(departure)), f"{trip_id}:start", f"{trip_id}:end")
+            await pipe.execute()
+
+class InMemorySpatialIndex(SpatialIndex):
+    """Grid-bucketed index held by this process, for single-node deployments and tests"""
+
+    persistent = False
+
+    def __init__(self, cell_deg: float = 0.02):
+        self.cell_deg = cell_deg
+        # trip_id -> (bucket, start, end)
+        self.trips: Dict[int, Tuple[int, Point, Point]] = {}
+        # bucket -> grid cell of the start point -> trip ids
+        self.start_cells: Dict[int, Dict[Tuple[int, int], Set[int]]] = defaultdict(lambda: defaultdict(set))
+
+    def cell(self, point: Point) -> Tuple[int, int]:
+        return (math.floor(point[0] / self.cell_deg), math.floor(point[1] / self.cell_deg))
+
+    def cells_around(self, point: Point, radius_km: float):
+        # A degree of latitude is ~111 km, longitude degrees shrink with latitude
+        reach_lat = radius_km / 111.0
+        reach_lon = reach_lat / max(math.cos(math.radians(point[1])), 1e-6)
+        min_x, min_y = self.cell((point[0] - reach_lon, point[1] - reach_lat))
+        max_x, max_y = self.cell((point[0] + reach_lon, point[1] + reach_lat))
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield (x, y)
+
+    async def match_candidates(self, trip_id, start, end, departure, radius_km=GEO_SEARCH_RADIUS_KM):
+        bucket = geo_bucket(departure)
+        radius_m = radius_km * 1000
+        if trip_id not in self.trips:
+            self.add(trip_id, start, end, bucket)
+
+        matches = []
+        for b in (bucket, bucket - 1, bucket + 1):
+            grid = self.start_cells.get(b)
+            if not grid:
+                continue
+            for cell in self.cells_around(start, radius_km):
+                for other_id in grid.get(cell, ()):
+                    if other_id == trip_id:
+                        continue
+                    _, other_start, other_end = self.trips[other_id]
+                    if haversine_m(start, other_start) <= radius_m and haversine_m(end, other_end) <= radius_m:
+                        matches.append(other_id)
+        return matches
+
+    def add(self, trip_id: int, start: Point, end: Point, bucket: int) -> None:
+        self.expire_buckets()
+        self.trips[trip_id] = (bucket, start, end)
+        self.start_cells[bucket][self.cell(start)].add(trip_id)
+
+    def expire_buckets(self) -> None:
+        """Drop windows that closed more than the grace period ago, as Redis expires its buckets.
+        Only the expiry leader removes trips one by one, other workers rely on this."""
+        now = datetime.now(timezone.utc).timestamp()
+        for bucket in [b for b in self.start_cells if (b + 1) * GEO_BUCKET_SECONDS + GEO_BUCKET_GRACE_SECONDS < now]:
+            for trip_ids in self.start_cells.pop(bucket).values():
+                for trip_id in trip_ids:
+                    self.trips.pop(trip_id, None)
+
+    async def add_many(self, trips):
+        for trip_id, start, end, departure in trips:
+            if trip_id not in self.trips:
+                self.add(trip_id, start, end, geo_bucket(departure))
+
+    async def remove(self, trips):
+        for trip_id, _ in trips:
+            entry = self.trips.pop(trip_id, None)
+            if entry is None:
+                continue
+            bucket, start, _ = entry
+            grid = self.start_cells[bucket]
+            cell = self.cell(start)
+            grid[cell].discard(trip_id)
+            if not grid[cell]:
+                del grid[cell]
+            if not grid:
+                del self.start_cells[bucket]
+
+def create_spatial_index(backend: str = None) -> SpatialIndex:
+    backend = backend or os.getenv("SPATIAL_INDEX_BACKEND", "redis")
+    if backend == "memory":
+        return InMemorySpatialIndex()
+    if backend == "redis":
+        return RedisSpatialIndex()
+    raise ValueError(f"Unknown spatial index backend: {backend}")
+
+spatial_index = create_spatial_index()
@@ -6,6 +6,11 @@ import schemas
 import logging
 import redis
 import json
+from urllib.parse import unquote, unquote_plus
+from cache import TTLCache
+from route_cache import RouteCache
+import ors_client
+from resources import resources
 
 load_dotenv()
 
@@ -16,18 +21,88 @@ router = APIRouter(
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
-hash_key = "trips"
+route_cache = RouteCache()
 
-orsToken = os.getenv("orsToken")
+# Identical cache misses in flight at the same time share one ORS call
+ors_requests = ors_client.SingleFlight()
+
+AUTOCOMPLETE_SIZE = 3
+# Places do not move, so suggestions can be kept for a long time
+AUTOCOMPLETE_CACHE_TTL_SECONDS = int(os.getenv("AUTOCOMPLETE_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+AUTOCOMPLETE_LOCAL_CACHE_SIZE = int(os.getenv("AUTOCOMPLETE_LOCAL_CACHE_SIZE", "5000"))
+
+# In-process tier in front of the shared Redis tier, both keyed on the normalized text.
+# Entries are {"response": ORS json, "exhaustive": fewer than AUTOCOMPLETE_SIZE results}
+autocomplete_cache = TTLCache(maxsize=AUTOCOMPLETE_LOCAL_CACHE_SIZE, ttl=AUTOCOMPLETE_CACHE_TTL_SECONDS)
+# Per request, the local cache counts every prefix it was asked about
+autocomplete_stats = {"requests": 0, "hits": 0, "prefix_hits": 0}
+
+def normalize_query(encoded_text: str) -> str:
+    return " ".join(unquote_plus(encoded_text).lower().split())
+
+def autocomplete_key(query: str) -> str:
+    return f"autocomplete:{query}"
+
+def matches_query(feature: dict, query: str) -> bool:
+    # Every word typed must start a word of the place's name or label
+    properties = feature.get("properties", {})
+    words = normalize_query(f"{properties.get('name', '')} {properties.get('label', '')}").replace(",", " ").split()
+    return all(any(word.startswith(token) for word in words) for token in query.split())
+
+async def cached_autocomplete(query: str):
+    """Cached response for query, or one derived from an exhaustive shorter prefix"""
+    prefixes = [query[:end] for end in range(len(query), 0, -1)]
+    entries = {prefix: autocomplete_cache.get(prefix) for prefix in prefixes}
+
+    missing = [prefix for prefix in prefixes if entries[prefix] is None]
+    if missing:
+        try:
+            values = await resources.async_redis.mget([autocomplete_key(prefix) for prefix in missing])
+        except redis.RedisError as exc:
+            logger.warning(f"Autocomplete cache unavailable: {exc}")
+            values = [None] * len(missing)
+        for prefix, value in zip(missing, values):
+            if value is not None:
+                entries[prefix] = json.loads(value)
+                autocomplete_cache.set(prefix, entries[prefix])
+
+    for prefix in prefixes:
+        entry = entries[prefix]
+        if entry is None:
+            continue
+        if prefix == query:
+            autocomplete_stats["hits"] += 1
+            return entry["response"]
+        if entry["exhaustive"]:
+            autocomplete_stats["prefix_hits"] += 1
+            # ORS had nothing more for the shorter text, so the longer text's results are among these
+            response = entry["response"]
+            return {**response, "features": [f for f in response.get("features", []) if matches_query(f, query)]}
+    return None
+
+async def store_autocomplete(query: str, response: dict) -> None:
+    entry = {"response": response, "exhaustive": len(response.get("features", [])) < AUTOCOMPLETE_SIZE}
+    autocomplete_cache.set(query, entry)
+    try:
+        await resources.async_redis.set(autocomplete_key(query), json.dumps(entry), ex=AUTOCOMPLETE_CACHE_TTL_SECONDS)
+    except redis.RedisError as exc:
+        logger.warning(f"Autocomplete cache unavailable: {exc}")
 
 @router.post("/suggestions")
 async def suggestions_request(suggestion_request: schemas.Suggestions_Input):
+    query = normalize_query(suggestion_request.encoded_URI_component)
+    autocomplete_stats["requests"] += 1
+    cached = await cached_autocomplete(query)
+    if cached is not None:
+        return cached
+
+    async def fetch_suggestions():
+        response_json = await ors_client.autocomplete(unquote(suggestion_request.encoded_URI_component), AUTOCOMPLETE_SIZE)
+        await store_autocomplete(query, response_json)
+        return response_json
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"https://api.openrouteservice.org/geocode/autocomplete?api_key={orsToken}&text={suggestion_request.encoded_URI_component}&size=3")
-            response.raise_for_status()
-            return response.json()
+        return await ors_requests.do(("autocomplete", query), fetch_suggestions)
     except httpx.HTTPStatusError as exc:
         raise HTTPException(status_code=exc.response.status_code, detail=f"Error from external API: {exc.response.text}")
     except httpx.RequestError as exc:
@@ -41,45 +116,40 @@ async def fetch_coordinates(coordinates_data: schemas.Coordinates):
     # else call external api
     # save new coordinates and route coordinates and time
 
-    query_field = json.dumps(coordinates_data.coordinates)
-    field_data = redis_client.hget(hash_key, query_field)
+    cached = await route_cache.get(coordinates_data.coordinates)
 
-    if field_data:
+    if cached:
         # get route coordinates
-        result = json.loads(field_data)
-        coords = result["coordinates"]
-        duration = result["duration"]
+        coords, duration = cached
         return {
             "coordinates": coords,
             "duration": duration
         }
     else:
-        url = "https://api.openrouteservice.org/v2/directions/driving-car/geojson"
-        headers = {
-            "Authorization": orsToken,
-            "Content-Type": "application/json"
-        }
-        data = { "coordinates": coordinates_data.coordinates}
-
-        try:
-            response = httpx.post(url, headers=headers, json=data)
-            response.raise_for_status()
-            response_json = response.json()
+        async def fetch_route():
+            response_json = await ors_client.directions(coordinates_data.coordinates)
             coords = response_json["features"][0]["geometry"]["coordinates"]
             duration = response_json["features"][0]["properties"]["summary"]["duration"]
 
-            coords_radis = json.dumps(coordinates_data.coordinates)
-            value_to_store = json.dumps({
-                "coordinates": coords,
-                "duration": duration
-            })
-            redis_client.hset(hash_key, coords_radis, value_to_store)
+            await route_cache.set(coordinates_data.coordinates, coords, duration)
 
             return {
                 "coordinates": coords,
                 "duration": duration
             }
+
+        try:
+            # Requests for the same grid cells would be served the same cached route anyway
+            return await ors_requests.do(("directions", route_cache.cell_key(coordinates_data.coordinates)), fetch_route)
         except httpx.HTTPStatusError as exc:
             raise HTTPException(status_code=exc.response.status_code, detail=f"Error from external API: {exc.response.text}")
         except httpx.RequestError as exc:
             raise HTTPException(status_code=500, detail=f"An error occurred while requesting external API: {exc}")
+
+
+@router.get("/cache_stats")
+async def cache_stats():
+    return {
+        "routes": await route_cache.stats(),
+        "autocomplete": {**autocomplete_stats, "local": autocomplete_cache.stats()},
+    }
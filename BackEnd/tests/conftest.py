@@ -0,0 +1,13 @@
+import os
+import sys
+import pytest
+
+# The app's modules import each other by bare name, as when run from BackEnd/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite://")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from database import Base
+from models import CarpoolGroup, Trip, User
+import carpool_groups
+import match_graph
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+async def db():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as session:
+        yield session
+    await engine.dispose()
+
+async def add_trips(db: AsyncSession, count: int) -> list:
+    departure = datetime.now(timezone.utc) + timedelta(hours=1)
+    trips = []
+    for i in range(count):
+        user = User(email=f"rider{i}@example.com", age=30, gender="female", hashed_password="x")
+        trips.append(Trip(origin_name="A", target_name="B", time=departure, gender="female", user=user))
+    db.add_all(trips)
+    await db.flush()
+    return trips
+
+async def link(db: AsyncSession, *edges) -> None:
+    """Record (trip, trip, distance_km) matches in both directions"""
+    await match_graph.record_batch(db, [], [
+        {"trip1_id": a.id, "trip2_id": b.id, "hausdorff_distance_km": distance} for a, b, distance in edges
+    ])
+
+async def link_all(db: AsyncSession, trips: list) -> None:
+    await link(db, *[(a, b, 0.1 * (i + j)) for i, a in enumerate(trips) for j, b in enumerate(trips) if i < j])
+
+async def members(db: AsyncSession, group_id: int) -> set:
+    return set((await db.execute(select(Trip.id).where(Trip.group_id == group_id))).scalars())
+
+async def group_of(db: AsyncSession, trip: Trip):
+    return await db.scalar(select(Trip.group_id).where(Trip.id == trip.id))
+
+async def cancel(db: AsyncSession, *trips) -> list:
+    """What cancelling or expiring does: read the groups, drop the trips, settle"""
+    trip_ids = [trip.id for trip in trips]
+    group_ids = (await db.execute(carpool_groups.groups_of(trip_ids))).scalars().all()
+    await match_graph.remove_trips(db, trip_ids)
+    await db.execute(delete(Trip).where(Trip.id.in_(trip_ids)))
+    return await carpool_groups.settle_groups(db, group_ids)
+
+async def test_nobody_to_share_with(db):
+    trip, = await add_trips(db, 1)
+    assert await carpool_groups.assign_group(db, trip) is None
+
+async def test_new_group_is_filled_to_capacity(db):
+    trips = await add_trips(db, carpool_groups.CAR_CAPACITY + 2)
+    await link_all(db, trips)
+
+    group_id = await carpool_groups.assign_group(db, trips[0])
+
+    # The closest matches go first
+    assert await members(db, group_id) == {trip.id for trip in trips[:carpool_groups.CAR_CAPACITY]}
+    assert (await db.get(CarpoolGroup, group_id)).capacity == carpool_groups.CAR_CAPACITY
+
+async def test_full_group_is_not_joined(db):
+    trips = await add_trips(db, carpool_groups.CAR_CAPACITY + 2)
+    await link_all(db, trips)
+    first = await carpool_groups.assign_group(db, trips[0])
+
+    # Matches everyone in the full car, so it has to start another with the one left over
+    second = await carpool_groups.assign_group(db, trips[-2])
+
+    assert second != first
+    assert len(await members(db, first)) == carpool_groups.CAR_CAPACITY
+    assert await members(db, second) == {trips[-2].id, trips[-1].id}
+
+async def test_new_group_only_takes_trips_that_all_matched(db):
+    a, b, c, d = await add_trips(db, 4)
+    # d matched a, but neither b nor c
+    await link(db, (a, b, 0.1), (a, c, 0.2), (b, c, 0.1), (a, d, 0.3))
+
+    group_id = await carpool_groups.assign_group(db, a)
+
+    assert await members(db, group_id) == {a.id, b.id, c.id}
+    assert await group_of(db, d) is None
+
+async def test_group_is_only_joined_by_a_match_of_every_member(db):
+    a, b, c, d = await add_trips(db, 4)
+    await link(db, (a, b, 0.1))
+    group_id = await carpool_groups.assign_group(db, a)
+
+    # Later arrivals: c matched a only, d matched both
+    await link(db, (c, a, 0.1), (d, a, 0.2), (d, b, 0.2))
+    assert await carpool_groups.assign_group(db, c) is None
+    assert await carpool_groups.assign_group(db, d) == group_id
+    assert await members(db, group_id) == {a.id, b.id, d.id}
+
+async def test_group_keeps_going_after_a_member_leaves(db):
+    a, b, c = await add_trips(db, 3)
+    await link_all(db, [a, b, c])
+    group_id = await carpool_groups.assign_group(db, a)
+
+    changed = await cancel(db, a)
+
+    assert sorted(changed) == sorted([b.id, c.id])
+    assert await members(db, group_id) == {b.id, c.id}
+    assert await db.get(CarpoolGroup, group_id) is not None
+
+async def test_lone_member_is_released(db):
+    a, b = await add_trips(db, 2)
+    await link(db, (a, b, 0.1))
+    group_id = await carpool_groups.assign_group(db, a)
+
+    assert await cancel(db, a) == [b.id]
+
+    assert await group_of(db, b) is None
+    assert await db.get(CarpoolGroup, group_id) is None
+
+async def test_lone_member_is_placed_again(db):
+    a, b, c = await add_trips(db, 3)
+    # c matched b only, so it stayed out of a and b's car
+    await link(db, (a, b, 0.1), (b, c, 0.2))
+    await carpool_groups.assign_group(db, a)
+    assert await carpool_groups.assign_group(db, c) is None
+
+    assert await cancel(db, a) == [b.id]
+
+    # SQLite may hand the dissolved group's id to the new one, compare the rows instead
+    groups = (await db.execute(select(CarpoolGroup.id))).scalars().all()
+    assert len(groups) == 1
+    assert await members(db, groups[0]) == {b.id, c.id}
+
+async def test_empty_group_is_deleted(db):
+    a, b = await add_trips(db, 2)
+    await link(db, (a, b, 0.1))
+    group_id = await carpool_groups.assign_group(db, a)
+
+    assert await cancel(db, a, b) == []
+    assert await db.get(CarpoolGroup, group_id) is None
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import directed_hausdorff
+import hausdorff
+
+THRESHOLD = hausdorff.CARPOOL_THRESHOLD_M
+
+def random_route(rng, points: int, origin=(0.0, 0.0)) -> np.ndarray:
+    """A wandering route in metres, steps of up to ~80 m"""
+    steps = rng.normal(scale=40.0, size=(points, 2)) + rng.normal(scale=30.0, size=2)
+    return np.asarray(origin) + np.cumsum(steps, axis=0)
+
+def near(rng, route: np.ndarray, spread: float) -> np.ndarray:
+    """Another route along the same road, every point moved by noise of about spread metres"""
+    return route + rng.normal(scale=spread, size=route.shape)
+
+@pytest.fixture
+def routes():
+    rng = np.random.default_rng(7)
+    base = random_route(rng, 300)
+    routes = [base, near(rng, base, 20), near(rng, base, 150), near(rng, base, 400)]
+    routes += [random_route(rng, int(n), rng.uniform(-3000, 3000, size=2)) for n in rng.integers(20, 600, size=6)]
+    # Longer than a decision chunk, so the chunked path is exercised
+    routes.append(near(rng, random_route(rng, 2 * hausdorff.DECISION_CHUNK_SIZE + 17), 10))
+    return routes
+
+def reference(a: np.ndarray, b: np.ndarray) -> float:
+    return max(directed_hausdorff(a, b)[0], directed_hausdorff(b, a)[0])
+
+def reference_matrix(routes) -> np.ndarray:
+    return np.array([[reference(a, b) for b in routes] for a in routes])
+
+def test_exact_matrix_matches_scipy(routes):
+    np.testing.assert_allclose(hausdorff.hausdorff_matrix(routes), reference_matrix(routes))
+
+def test_threshold_matrix_is_exact_below_threshold_and_inf_otherwise(routes):
+    expected = reference_matrix(routes)
+    below = expected < THRESHOLD
+    # Some pairs on each side, or the test proves nothing
+    assert below[~np.eye(len(routes), dtype=bool)].any() and not below.all()
+
+    distances = hausdorff.hausdorff_matrix(routes, threshold=THRESHOLD)
+
+    np.testing.assert_allclose(distances[below], expected[below])
+    assert np.isinf(distances[~below]).all()
+
+def test_pairs_outside_candidates_are_inf(routes):
+    candidates = np.ones((len(routes), len(routes)), dtype=bool)
+    candidates[0, 1] = candidates[1, 0] = False
+
+    for threshold in (None, THRESHOLD):
+        distances = hausdorff.hausdorff_matrix(routes, candidates, threshold)
+        assert np.isinf(distances[0, 1]) and np.isinf(distances[1, 0])
+        assert np.isfinite(distances[0, 0])
+
+def test_directed_within_matches_scipy(routes):
+    a, b = routes[0], routes[1]
+    expected = directed_hausdorff(a, b)[0]
+    assert hausdorff.directed_within(a, cKDTree(b), THRESHOLD) == pytest.approx(expected)
+
+def test_directed_within_is_inf_at_or_above_threshold(routes):
+    a, b = routes[0], routes[2]
+    expected = directed_hausdorff(a, b)[0]
+    tree = cKDTree(b)
+    assert hausdorff.directed_within(a, tree, expected) == np.inf
+    assert hausdorff.directed_within(a, tree, expected / 2) == np.inf
+    assert hausdorff.directed_within(a, tree, expected * 1.01) == pytest.approx(expected)
+
+def test_pair_distances_match_scipy(routes):
+    trees = [cKDTree(route) for route in routes]
+    pairs = np.argwhere(np.triu(np.ones((len(routes), len(routes)), dtype=bool), k=1))
+
+    distances = hausdorff.pair_distances(routes, trees, pairs, THRESHOLD)
+
+    for (i, j), distance in zip(pairs.tolist(), distances):
+        expected = reference(routes[i], routes[j])
+        if expected < THRESHOLD:
+            assert distance == pytest.approx(expected)
+        else:
+            assert distance == np.inf
+
+@pytest.mark.parametrize("tolerance", [5.0, 25.0, 100.0])
+def test_simplified_route_stays_within_tolerance(routes, tolerance):
+    for route in routes:
+        simplified = hausdorff.simplify_route(route, tolerance)
+
+        assert len(simplified) <= len(route)
+        np.testing.assert_array_equal(simplified[0], route[0])
+        np.testing.assert_array_equal(simplified[-1], route[-1])
+        # Kept points are original points, in order
+        kept = [np.flatnonzero((route == point).all(axis=1))[0] for point in simplified]
+        assert kept == sorted(kept)
+        assert reference(route, simplified) <= tolerance + 1e-9
+
+def test_simplify_thins_densely_sampled_routes():
+    # A point every metre, dropped ones only need a kept point within the tolerance
+    straight = np.column_stack((np.linspace(0, 5000, 5001), np.zeros(5001)))
+    simplified = hausdorff.simplify_route(straight, 25.0)
+    assert len(simplified) < len(straight) // 10
+    assert reference(straight, simplified) <= 25.0
+
+def test_simplify_leaves_short_routes_alone():
+    route = np.array([[0.0, 0.0], [10.0, 10.0]])
+    assert hausdorff.simplify_route(route, 50.0) is route
+
+def test_bbox_bound_never_exceeds_the_distance(routes):
+    bboxes = np.array([(*route.min(axis=0), *route.max(axis=0)) for route in routes])
+
+    bounds = hausdorff.bbox_lower_bounds(bboxes)
+
+    assert (bounds <= reference_matrix(routes) + 1e-9).all()
+    np.testing.assert_array_equal(np.diag(bounds), 0)
+
+def test_packed_route_round_trips(routes):
+    for route in routes:
+        np.testing.assert_array_equal(hausdorff.unpack_route(hausdorff.pack_route(route)), route)
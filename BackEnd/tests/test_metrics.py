@@ -0,0 +1,39 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.testclient import TestClient
+import metrics
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(metrics.request_seconds, "values", {})
+    app = FastAPI()
+
+    @app.get("/trips/{trip_id}")
+    async def trip(trip_id: int):
+        return {"id": trip_id}
+
+    app.add_middleware(CORSMiddleware, allow_origins=["http://localhost:3000"], allow_methods=["*"])
+    app.add_middleware(metrics.MetricsMiddleware)
+    return TestClient(app)
+
+def routes(histogram) -> set:
+    return {labels[1] for labels in histogram.values}
+
+def test_matched_requests_are_labelled_by_route_template(client):
+    for trip_id in range(3):
+        client.get(f"/trips/{trip_id}")
+    assert routes(metrics.request_seconds) == {"/trips/{trip_id}"}
+
+def test_unmatched_paths_share_one_label(client):
+    preflight = {"Origin": "http://localhost:3000", "Access-Control-Request-Method": "GET"}
+    for path in ("/a1", "/a2", "/zz/q"):
+        assert client.options(path, headers=preflight).status_code == 200
+    assert client.get("/random/path/x").status_code == 404
+
+    assert routes(metrics.request_seconds) == {"unmatched"}
+    assert {labels[2] for labels in metrics.request_seconds.values} == {"200", "404"}
+
+def test_metric_without_samples_cannot_be_created():
+    with pytest.raises(TypeError):
+        metrics.Metric("rideshare_test", "Incomplete metric")
@@ -0,0 +1,112 @@
+import asyncio
+import httpx
+import pytest
+import ors_client
+
+pytestmark = pytest.mark.anyio
+
+WAITERS = 10
+
+class Upstream:
+    """ORS stand-in that holds every request until released, so callers overlap"""
+
+    def __init__(self, status_code: int = 200):
+        self.status_code = status_code
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        await self.release.wait()
+        return httpx.Response(self.status_code, json={"features": [{"properties": {"name": request.url.params["text"]}}]})
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = Upstream()
+    client = httpx.AsyncClient(base_url=ors_client.ORS_BASE_URL, transport=httpx.MockTransport(upstream.handle))
+    monkeypatch.setattr(ors_client, "_client", client)
+    return upstream
+
+async def gather_released(upstream: Upstream, calls):
+    tasks = [asyncio.create_task(call) for call in calls]
+    # Let every caller reach the flight before the upstream answers
+    await asyncio.sleep(0.01)
+    upstream.release.set()
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+async def test_concurrent_calls_share_one_request(upstream):
+    flight = ors_client.SingleFlight()
+    results = await gather_released(upstream, [
+        flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3)) for _ in range(WAITERS)
+    ])
+
+    assert upstream.calls == 1
+    assert all(result == results[0] for result in results)
+    assert results[0]["features"][0]["properties"]["name"] == "Lekki"
+
+async def test_different_keys_are_not_coalesced(upstream):
+    flight = ors_client.SingleFlight()
+    results = await gather_released(upstream, [
+        flight.do(text, lambda text=text: ors_client.autocomplete(text, 3)) for text in ("Lekki", "Ikeja")
+    ])
+
+    assert upstream.calls == 2
+    assert [result["features"][0]["properties"]["name"] for result in results] == ["Lekki", "Ikeja"]
+
+async def test_error_reaches_every_waiter(upstream):
+    upstream.status_code = 503
+    flight = ors_client.SingleFlight()
+    results = await gather_released(upstream, [
+        flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3)) for _ in range(WAITERS)
+    ])
+
+    assert upstream.calls == 1
+    assert len(results) == WAITERS
+    assert all(isinstance(result, httpx.HTTPStatusError) for result in results)
+    assert all(result.response.status_code == 503 for result in results)
+
+async def test_failed_call_is_forgotten(upstream):
+    upstream.status_code = 503
+    flight = ors_client.SingleFlight()
+    await gather_released(upstream, [flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3))])
+    assert flight.calls == {}
+
+    # The next miss goes upstream again instead of getting the old error
+    upstream.status_code = 200
+    result = await flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3))
+    assert upstream.calls == 2
+    assert result["features"][0]["properties"]["name"] == "Lekki"
+
+async def test_cancelled_waiter_does_not_cancel_the_call(upstream):
+    flight = ors_client.SingleFlight()
+    leader = asyncio.create_task(flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3)))
+    await asyncio.sleep(0.01)
+    waiter = asyncio.create_task(flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3)))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    upstream.release.set()
+
+    assert (await leader)["features"][0]["properties"]["name"] == "Lekki"
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert upstream.calls == 1
+    assert flight.calls == {}
+
+async def test_cancelled_leader_hands_the_call_to_a_waiter(upstream):
+    flight = ors_client.SingleFlight()
+    leader = asyncio.create_task(flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3)))
+    await asyncio.sleep(0.01)
+    waiters = [
+        asyncio.create_task(flight.do("Lekki", lambda: ors_client.autocomplete("Lekki", 3))) for _ in range(WAITERS)
+    ]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    await asyncio.sleep(0.01)
+    upstream.release.set()
+
+    results = await asyncio.gather(*waiters)
+    assert all(result["features"][0]["properties"]["name"] == "Lekki" for result in results)
+    # The leader's request and one more for all of the waiters
+    assert upstream.calls == 2
+    assert leader.cancelled()
+    assert flight.calls == {}
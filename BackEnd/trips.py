@@ -1,26 +1,31 @@
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError
+from fastapi import APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 import httpx
 import os
-import jwt
 import json
 import schemas
 import logging
 import pytz
-from sqlalchemy.orm import Session
+from sqlalchemy import select, delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Annotated, List
 from starlette import status
-from database import SessionLocal
+from collections import defaultdict
 from datetime import datetime
 from dependencies import get_db
-from hausdorff import similarity
+from hausdorff import similarity, load_route, route_geometry, forget_trips
 from models import User, Trip
-import redis
 from datetime import timedelta
-from dependencies import get_current_user_id
-from exponent_server_sdk import PushClient, PushMessage
+from security import get_current_user_id, get_current_claims, verify_token, credentials_exception
+from spatial_index import spatial_index
+from notifications import dispatcher
+from match_events import hub, match_added, matches_removed, group_updated
+import match_graph
+import carpool_groups
+import parallel_match
+from metrics import stage_seconds
+from resources import resources
 
 load_dotenv()
 
@@ -30,14 +35,9 @@ router = APIRouter(
     tags=['trips']
 )
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
-
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("AlGORITHM")
-
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+BULK_TRIPS_MAX_BATCH = int(os.getenv("BULK_TRIPS_MAX_BATCH", "1000"))
 
 # Get trip data
 # Get user from jwt and get their gender
@@ -45,44 +45,25 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # delete trip at the appropriate time from db
 # Get all trips from DB
 
-async def protected_route(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except (JWTError, jwt.PyJWTError):
-        raise credentials_exception
+async def protected_route(claims: dict = Depends(get_current_claims)):
+    return claims
+
+async def find_matches_pipeline(db: AsyncSession, trip: Trip):
+    trip_id = trip.id
 
-async def find_matches_pipeline(db: Session, trip_id: int, route_coordinates_json: str):
     # 1. Parse coordinates
-    coordinates_list = json.loads(route_coordinates_json)
+    coordinates_list = load_route(trip.route_coordinates)
     start_lon = coordinates_list[0]['longitude']
     start_lat = coordinates_list[0]['latitude']
     end_lon = coordinates_list[-1]['longitude']
     end_lat = coordinates_list[-1]['latitude']
 
-    # 2. Update Redis (Ensures this trip is indexable)
-    redis_client.geoadd('trips_geo_hash', (start_lon, start_lat, f"{trip_id}:start"))
-    redis_client.geoadd('trips_geo_hash', (end_lon, end_lat, f"{trip_id}:end"))
-
-    # 3. Find nearby trips using Georadius
-    nearby_start_bytes = redis_client.georadius('trips_geo_hash', start_lon, start_lat, 2, unit='km')
-    nearby_end_bytes = redis_client.georadius('trips_geo_hash', end_lon, end_lat, 2, unit='km')
-    
-    nearby_start = [item.decode('utf-8').split(':')[0] for item in nearby_start_bytes]
-    nearby_end = [item.decode('utf-8').split(':')[0] for item in nearby_end_bytes]
-
-    # 4. Filter for trips that match both ends
-    nearby_trips_intersect = list(set(nearby_start) & set(nearby_end))
-    
-    # Remove current trip ID so you don't match with yourself
-    nearby_trips = [int(tid) for tid in nearby_trips_intersect if int(tid) != trip_id]
+    # 2-4. Index this trip if needed and find trips starting near its start and
+    # ending near its end, in its own and the neighbouring departure windows
+    with stage_seconds.time("geo_lookup"):
+        nearby_trips = await spatial_index.match_candidates(
+            trip_id, (start_lon, start_lat), (end_lon, end_lat), trip.time
+        )
 
     # 5. Final Step: Pass the survivors to the Time + Path algorithm
     if not nearby_trips:
@@ -90,21 +71,71 @@ async def find_matches_pipeline(db: Session, trip_id: int, route_coordinates_jso
         
     return await carpool_match(db=db, trip_id=trip_id, nearby_trips=nearby_trips)
 
+async def seed_spatial_index() -> None:
+    """An index held in memory starts empty, give it the trips that have not departed yet"""
+    if spatial_index.persistent:
+        return
+    async with resources.async_session() as db:
+        active = (await db.execute(
+            select(Trip.id, Trip.route_coordinates, Trip.time).where(Trip.time >= datetime.now(pytz.utc))
+        )).all()
+
+    entries = []
+    for trip_id, route_coordinates, departure in active:
+        coordinates_list = load_route(route_coordinates)
+        if coordinates_list:
+            start, end = coordinates_list[0], coordinates_list[-1]
+            entries.append((trip_id, (start['longitude'], start['latitude']), (end['longitude'], end['latitude']), departure))
+    await spatial_index.add_many(entries)
+    logger.info(f"Spatial index seeded with {len(entries)} active trips")
+
+def match_summary(trip: Trip) -> dict:
+    return {
+        "id": trip.id,
+        "origin": trip.origin_name,
+        "destination": trip.target_name,
+        "time": trip.time,
+        "gender": trip.gender
+    }
+
+async def match_new_trip(db: AsyncSession, trip: Trip):
+    matches = await find_matches_pipeline(db, trip)
+    matched_ids = await match_graph.record_matches(db, trip, matches)
+    # Placed once here, every member then reads the same group
+    group_id = await carpool_groups.assign_group(db, trip) if matched_ids else None
+    await db.commit()
+
+    if group_id is not None:
+        await hub.publish(group_updated((await db.execute(carpool_groups.group_members([group_id]))).all()))
+
+    if matched_ids:
+        matched = await match_graph.load_matches(db, trip.id)
+        # Owners with the Trips screen open see the new match right away
+        await hub.publish(
+            (other_user.id, match_added(matched_trip.id, match_summary(trip)))
+            for matched_trip, other_user in matched
+        )
+
+        # notify the owners of the matched trips that this trip's user is a match.
+        # Queued and sent in the background, at most once per (user, trip)
+        for matched_trip, other_user in matched:
+            if other_user.push_token:
+                dispatcher.notify(
+                    other_user.id,
+                    trip.id,
+                    other_user.push_token,
+                    "New Carpool Match! 🚗",
+                    f"A new user is traveling from {trip.origin_name} to {trip.target_name}. Check your matches!"
+                )
+    return matches
+
 @router.post("/post_trips")
 async def post_trips(db: db_dependency, trips_schema: schemas.Trips):
 
-    try:
-        payload = jwt.decode(trips_schema.access_token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token payload")
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Could not validate token")
-    
-    user = db.query(User).filter(User.id == user_id).first()
-    previously_stored_trip = db.query(Trip).filter(Trip.user_id == user_id).first()
+    user_id = verify_token(trips_schema.access_token)["id"]
+
+    user = await db.get(User, user_id)
+    previously_stored_trip = (await db.execute(select(Trip).where(Trip.user_id == user_id))).scalars().first()
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -113,89 +144,246 @@ async def post_trips(db: db_dependency, trips_schema: schemas.Trips):
         return {"message": "User already has a trip"}
 
     else:
-        route_coordinates_json = json.dumps([
+        route_coordinates = [
             {"latitude": coord.latitude, "longitude": coord.longitude}
             for coord in trips_schema.route_coordinates
-        ])
+        ]
 
+        # Project once here so matching never has to decode and re-project this route
+        with stage_seconds.time("projection"):
+            geometry = route_geometry(route_coordinates)
         create_trip = Trip(
             origin_name=trips_schema.origin_name,
             target_name=trips_schema.target_name,
             time=trips_schema.time,
             gender=user.gender,
-            route_coordinates=route_coordinates_json,
+            route_coordinates=route_coordinates,
             user_id=user.id,
+            **geometry,
         )
 
         db.add(create_trip)
         logger.info("New Trip Created")
-        db.commit()
-        db.refresh(create_trip)
+        await db.commit()
+        await db.refresh(create_trip)
 
-        matches = await find_matches_pipeline(db, create_trip.id, route_coordinates_json)
+        matches = await match_new_trip(db, create_trip)
         print(matches)
-        return {"trip": create_trip, "matches": matches}
+        return {"trip": schemas.Trips_Return_Response.model_validate(create_trip), "matches": matches}
+
+def ndjson(line: dict) -> bytes:
+    return (json.dumps(line, default=str) + "\n").encode()
+
+async def validate_bulk(db: AsyncSession, items: List[schemas.Trips]):
+    """Accepted (index, user, item) and rejected {index, detail} of a bulk request, two queries in all"""
+    owners, rejected = {}, []
+    for index, item in enumerate(items):
+        try:
+            owners[index] = verify_token(item.access_token)["id"]
+        except HTTPException as e:
+            rejected.append({"index": index, "detail": e.detail})
+
+    user_ids = set(owners.values())
+    users = {user.id: user for user in (await db.execute(select(User).where(User.id.in_(user_ids)))).scalars()}
+    busy = set((await db.execute(select(Trip.user_id).where(Trip.user_id.in_(user_ids)))).scalars())
+
+    accepted = []
+    for index, user_id in owners.items():
+        if user_id not in users:
+            rejected.append({"index": index, "detail": "User not found"})
+        elif user_id in busy:
+            rejected.append({"index": index, "detail": "User already has a trip"})
+        elif not items[index].route_coordinates:
+            rejected.append({"index": index, "detail": "Route has no coordinates"})
+        else:
+            # One trip per user, the batch included
+            busy.add(user_id)
+            accepted.append((index, users[user_id], items[index]))
+    return accepted, sorted(rejected, key=lambda r: r["index"])
+
+async def ingest_bulk(items: List[schemas.Trips]):
+    """Runs while the response streams, one NDJSON line per finished stage"""
+    async with resources.async_session() as db:
+        accepted, rejected = await validate_bulk(db, items)
+        yield ndjson({"stage": "validated", "accepted": len(accepted), "rejected": rejected})
+        if not accepted:
+            return
+
+        rows = []
+        with stage_seconds.time("projection"):
+            for _, user, item in accepted:
+                route_coordinates = [
+                    {"latitude": coord.latitude, "longitude": coord.longitude}
+                    for coord in item.route_coordinates
+                ]
+                rows.append({
+                    "origin_name": item.origin_name,
+                    "target_name": item.target_name,
+                    "time": item.time,
+                    "gender": user.gender,
+                    "route_coordinates": route_coordinates,
+                    "user_id": user.id,
+                    **route_geometry(route_coordinates),
+                })
+        # One multi-row insert, ids come back in the order of rows
+        trip_ids = list((await db.execute(
+            insert(Trip).returning(Trip.id, sort_by_parameter_order=True), rows
+        )).scalars())
+        await db.commit()
+        logger.info(f"{len(trip_ids)} Trips Created in bulk")
+        yield ndjson({"stage": "inserted", "trips": [
+            {"index": index, "trip_id": trip_id} for (index, _, _), trip_id in zip(accepted, trip_ids)
+        ]})
+
+        try:
+            # Index every trip and find its neighbours in one Redis round trip
+            with stage_seconds.time("geo_lookup"):
+                nearby = await spatial_index.match_candidates_many(
+                    (trip_id, (row["route_coordinates"][0]["longitude"], row["route_coordinates"][0]["latitude"]),
+                     (row["route_coordinates"][-1]["longitude"], row["route_coordinates"][-1]["latitude"]), row["time"])
+                    for trip_id, row in zip(trip_ids, rows)
+                )
+            yield ndjson({"stage": "indexed", "candidates": sum(map(len, nearby))})
+
+            involved = set(trip_ids).union(*nearby)
+            with stage_seconds.time("candidate_fetch"):
+                trips = {t.id: t for t in (await db.execute(select(Trip).where(Trip.id.in_(involved)))).scalars()}
+            thirty_minutes = timedelta(minutes=30)
+            allowed = {
+                (trip_id, other_id)
+                for trip_id, others in zip(trip_ids, nearby)
+                for other_id in others
+                if other_id in trips and abs(trips[other_id].time - trips[trip_id].time) <= thirty_minutes
+            }
+
+            # One pairwise pass over the batch and its candidates, limited to the pairs above
+            with stage_seconds.time("hausdorff"):
+                matches = await parallel_match.match_trips(
+                    [trips[trip_id] for trip_id in sorted(involved) if trip_id in trips], allowed
+                ) if allowed else []
+            await match_graph.record_batch(db, trip_ids, matches)
+
+            matched = defaultdict(list)
+            for match in matches:
+                matched[match["trip1_id"]].append(match["trip2_id"])
+                matched[match["trip2_id"]].append(match["trip1_id"])
+            yield ndjson({"stage": "matched", "matches": [
+                {"trip_id": trip_id, "matched_trip_ids": matched[trip_id]} for trip_id in trip_ids
+            ]})
+
+            for trip_id in trip_ids:
+                if matched[trip_id]:
+                    await carpool_groups.assign_group(db, trips[trip_id])
+            await db.commit()
+            groups = {trip_id: group_id for _, trip_id, group_id in
+                      (await db.execute(carpool_groups.trip_groups(trip_ids))).all()}
+        except Exception as e:
+            # The trips are stored, get_matches computes their matches on the first poll
+            logger.error(f"Bulk matching failed: {e}")
+            await db.rollback()
+            yield ndjson({"stage": "failed", "detail": "Matching failed, matches will be computed on request"})
+            return
+
+        yield ndjson({"stage": "grouped", "groups": [
+            {"trip_id": trip_id, "group_id": groups.get(trip_id)} for trip_id in trip_ids
+        ]})
+
+        await notify_bulk(db, trip_ids, matches, trips, [g for g in set(groups.values()) if g is not None])
+
+async def notify_bulk(db: AsyncSession, trip_ids: List[int], matches: List[dict], trips: dict, group_ids: List[int]):
+    new = set(trip_ids)
+    owners = {user.id: user for user in (await db.execute(
+        select(User).where(User.id.in_({trip.user_id for trip in trips.values()}))
+    )).scalars()}
+
+    events = []
+    for match in matches:
+        for trip_id, other_id in ((match["trip1_id"], match["trip2_id"]), (match["trip2_id"], match["trip1_id"])):
+            if trip_id not in new:
+                continue
+            # The owner of other_id learns about the new trip_id, as in match_new_trip
+            trip, owner = trips[trip_id], owners[trips[other_id].user_id]
+            events.append((owner.id, match_added(other_id, match_summary(trip))))
+            if owner.push_token:
+                dispatcher.notify(
+                    owner.id,
+                    trip_id,
+                    owner.push_token,
+                    "New Carpool Match! 🚗",
+                    f"A new user is traveling from {trip.origin_name} to {trip.target_name}. Check your matches!"
+                )
+    if group_ids:
+        events.extend(group_updated((await db.execute(carpool_groups.group_members(group_ids))).all()))
+    await hub.publish(events)
+
+@router.post("/bulk_trips")
+async def bulk_trips(trips_schema: schemas.Bulk_Trips):
+    if len(trips_schema.trips) > BULK_TRIPS_MAX_BATCH:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {BULK_TRIPS_MAX_BATCH} trips per request"
+        )
+    # The session is opened by the stream itself, it outlives this handler
+    return StreamingResponse(ingest_bulk(trips_schema.trips), media_type="application/x-ndjson")
 
 @router.get("/get_matches")
 async def get_matches(db: db_dependency, trip_id: int):
     # Fetch the trip belonging to the user currently looking at the screen
-    current_trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    current_trip = await db.get(Trip, trip_id)
     if not current_trip:
         raise HTTPException(status_code=404, detail="Trip not found")
-        
-    # Run the pipeline to find who matches with this trip
-    matches = await find_matches_pipeline(db, current_trip.id, current_trip.route_coordinates)
-    
-    if not matches or isinstance(matches, dict):
-        return []
 
-    matched_trip_data = []
-    seen_ids = set()
-    notified_user_ids = set() 
+    # Trips stored before matches were persisted get their edges once, here
+    if current_trip.matched_at is None:
+        await match_new_trip(db, current_trip)
 
-    for match in matches:
-        # Determine the ID of the 'other' trip
-        if match["trip1_id"] == current_trip.id:
-            other_id = match["trip2_id"]
-        elif match["trip2_id"] == current_trip.id:
-            other_id = match["trip1_id"]
-        else:
-            continue
+    # Edges were written as trips arrived, so this is a single indexed read
+    return [match_summary(matched_trip) for matched_trip, _ in await match_graph.load_matches(db, current_trip.id)]
 
-        if other_id == current_trip.id or other_id in seen_ids:
-            continue
+@router.get("/group")
+async def get_group(db: db_dependency, trip_id: int, user_id: int = Depends(get_current_user_id)):
+    trip = await db.get(Trip, trip_id)
+    # Members' names and routes are only shown to someone riding in the group
+    if not trip or trip.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if trip.group_id is None:
+        return {"group_id": None, "capacity": carpool_groups.CAR_CAPACITY, "members": []}
+
+    group = await db.get(carpool_groups.CarpoolGroup, trip.group_id)
+    members = await carpool_groups.load_group(db, trip.group_id)
+    return {
+        "group_id": trip.group_id,
+        "capacity": group.capacity,
+        "members": [match_summary(member) for member, _ in members],
+    }
+
+@router.websocket("/ws/matches")
+async def match_updates(websocket: WebSocket):
+    # The token comes in the Authorization header like on every other route: React Native's
+    # WebSocket takes headers, and a query string would put it in every access log
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    try:
+        if scheme.lower() != "bearer" or not token:
+            raise credentials_exception
+        user_id = verify_token(token)["id"]
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-        # Fetch the 'other' trip details
-        matched_trip = db.query(Trip).filter(Trip.id == other_id).first()
-        
-        if matched_trip:
-            seen_ids.add(other_id)
-            matched_trip_data.append({
-                "id": matched_trip.id,
-                "origin": matched_trip.origin_name,
-                "destination": matched_trip.target_name,
-                "time": matched_trip.time,
-                "gender": matched_trip.gender
-            })
-
-            # notify the owner of the 'matched_trip' that 'current_trip' user is a match
-            if matched_trip.user_id not in notified_user_ids:
-                other_user = db.query(User).filter(User.id == matched_trip.user_id).first()
-                
-                if other_user and other_user.push_token:
-                    send_push_notification(
-                        other_user.push_token,
-                        "New Carpool Match! 🚗",
-                        f"A new user is traveling from {current_trip.origin_name} to {current_trip.target_name}. Check your matches!"
-                    )
-                    # Mark as notified so we don't send 2+ pings if they have multiple matching trips
-                    notified_user_ids.add(matched_trip.user_id)
-            
-    return matched_trip_data
+    await websocket.accept()
+    hub.connect(user_id, websocket)
+    try:
+        # Nothing is expected from the client, this only notices it going away
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.disconnect(user_id, websocket)
 
 @router.post("/get_trip_status")
 async def get_trip_status(db: db_dependency, user_id: int = Depends(get_current_user_id)):
-    trip = db.query(Trip).filter(Trip.user_id == user_id).first()
+    trip = (await db.execute(select(Trip).where(Trip.user_id == user_id))).scalars().first()
     return bool(trip)
 
 @router.get("/carpool_match")
@@ -204,54 +392,56 @@ async def carpool_match(db: db_dependency, trip_id: int, nearby_trips: List):
     matches = []
     thirty_minutes = timedelta(minutes=30)
 
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip = await db.get(Trip, trip_id)
     trip_time = trip.time
     matches.append(trip_id)
 
-    for trip in nearby_trips:
-        # Avoid matching with yourself if Redis returned your own ID
-        if int(trip) == trip_id:
-            continue
+    # Avoid matching with yourself if Redis returned your own ID
+    candidate_ids = [int(tid) for tid in nearby_trips if int(tid) != trip_id]
+
+    # The geo buckets already narrowed this down to neighbouring windows, one query
+    # fetches the departure times of what is left
+    with stage_seconds.time("candidate_fetch"):
+        candidate_times = (await db.execute(select(Trip.id, Trip.time).where(Trip.id.in_(candidate_ids)))).all()
+
+    for matched_id, matched_time in candidate_times:
+        time_difference = abs(matched_time - trip_time)
 
-        matched_trip = db.query(Trip).filter(Trip.id == trip).first()
-        
-        if matched_trip is None:
-            # FIX: Use continue so the loop keeps looking at other trips
-            continue 
-            
-        time_difference = abs(matched_trip.time - trip_time)
-        
         if time_difference <= thirty_minutes:
-            matches.append(trip)
+            matches.append(matched_id)
     
     if len(matches) <= 1:
         return []
     else:
-        path_results = similarity(db=db, matches=matches)
+        # Only the requesting trip's pairs, edges between the candidates were written when they arrived
+        path_results = await similarity(
+            db=db, matches=matches, allowed={(trip_id, other_id) for other_id in matches[1:]}
+        )
         print(path_results)
-        # similarity
-        # append group_id
     return path_results
 
 @router.post("/cancel_trips")
 async def cancel_trips(db: db_dependency, user_id: int = Depends(get_current_user_id)):
-    db.query(Trip).filter(Trip.user_id == user_id).delete()
-    db.commit()
+    cancelled = (await db.execute(select(Trip.id, Trip.time).where(Trip.user_id == user_id))).all()
+    cancelled_ids = [trip_id for trip_id, _ in cancelled]
+    group_ids = (await db.execute(carpool_groups.groups_of(cancelled_ids))).scalars().all()
+    affected = await match_graph.remove_trips(db, cancelled_ids)
+    await db.execute(delete(Trip).where(Trip.user_id == user_id))
+    regrouped = await carpool_groups.settle_groups(db, group_ids)
+    await db.commit()
+
+    await hub.publish(matches_removed(affected))
+    if regrouped:
+        await hub.publish(group_updated((await db.execute(carpool_groups.trip_groups(regrouped))).all()))
+
+    # The cancel is committed, Redis being down must not turn it into an error
+    forget_trips(cancelled_ids)
+    await spatial_index.discard(cancelled)
     return {"message": "Successful"}
 
 @router.post("/fetch_trip")
 async def fetch_trip(db: db_dependency, user_id: int = Depends(get_current_user_id)):
-    trip = db.query(Trip).filter(Trip.user_id == user_id).first()
+    trip = (await db.execute(select(Trip).where(Trip.user_id == user_id))).scalars().first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     return {"trip_id": trip.id}
-
-from exponent_server_sdk import PushClient, PushMessage
-
-def send_push_notification(expo_token, title, message):
-    try:
-        response = PushClient().publish(
-            PushMessage(to=expo_token, title=title, body=message, sound="default")
-        )
-    except Exception as e:
-        print(f"Error sending push: {e}")
\ No newline at end of file
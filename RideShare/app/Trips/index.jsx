@@ -4,8 +4,8 @@ import { Ionicons, MaterialCommunityIcons } from '@expo/vector-icons';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import axios from 'axios';
 import { useRouter } from "expo-router";
-import { useEffect, useRef } from 'react';
-import { useQuery } from '@tanstack/react-query';
+import { useEffect, useRef, useState } from 'react';
+import { useQuery, useQueryClient } from '@tanstack/react-query';
 
 const API_URL = process.env.EXPO_PUBLIC_API_URL;
 
@@ -21,6 +21,46 @@ function TripsScreen() {
   const router = useRouter();
   const insets = useSafeAreaInsets();
   const isFirstLoad = useRef(true);
+  const queryClient = useQueryClient();
+  const [liveUpdates, setLiveUpdates] = useState(false);
+
+  // The server pushes match changes over a socket, polling is only a fallback while it is down
+  useEffect(() => {
+    let socket;
+    let retryTimer;
+    let retryDelay = 1000;
+    let closed = false;
+
+    const connect = async () => {
+      const token = await AsyncStorage.getItem('token');
+      if (!token || closed) return;
+
+      // React Native sends headers on the handshake, so the token stays out of the URL and the logs
+      socket = new WebSocket(`${API_URL.replace(/^http/, 'ws')}/trips/ws/matches`, null, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      socket.onopen = () => {
+        retryDelay = 1000;
+        setLiveUpdates(true);
+      };
+      socket.onmessage = () => {
+        queryClient.invalidateQueries({ queryKey: ['matches'] });
+      };
+      socket.onclose = () => {
+        setLiveUpdates(false);
+        if (closed) return;
+        retryTimer = setTimeout(connect, retryDelay);
+        retryDelay = Math.min(retryDelay * 2, 60000);
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      if (socket) socket.close();
+    };
+  }, [queryClient]);
 
   const fetchTripsAndMatches = async () => {
     try {
@@ -48,7 +88,7 @@ function TripsScreen() {
     queryFn: fetchTripsAndMatches,
     retry: false,
     refetchOnWindowFocus: false,
-    refetchInterval: 60000,
+    refetchInterval: liveUpdates ? false : 60000,
     staleTime: 60_000
   });
 